@@ -20,11 +20,14 @@ from keystoneauth1 import loading as ka_loading
 from oslo_config import cfg
 from oslo_log import log
 import pbr
+import six
 
 from gnocchi_nagios import gnocchi_client
+from gnocchi_nagios import metrics
 from gnocchi_nagios import opts
 from gnocchi_nagios import perfdata_dispatcher
 from gnocchi_nagios import perfdata_processor
+from gnocchi_nagios import perfdata_receiver
 
 LOG = log.getLogger(__name__)
 
@@ -35,13 +38,30 @@ class GnocchiNagiosServiceManager(cotyledon.ServiceManager):
         oslo_config_glue.setup(self, conf)
 
         self.conf = conf
-        self.queue = multiprocessing.Manager().Queue()
-
-        self.add(perfdata_dispatcher.PerfdataDispatcher,
-                 args=(self.conf, self.queue))
+        self.queue = None
+        self.ack_queue = None
+        self.shard_queues = None
+        if self.conf.dispatch_mode == 'queue' or self.conf.host_affinity:
+            manager = multiprocessing.Manager()
+        if self.conf.dispatch_mode == 'queue':
+            # NOTE: in claim mode, workers take their files themselves
+            self.queue = manager.Queue(
+                perfdata_dispatcher.get_queue_size(self.conf))
+            self.ack_queue = manager.Queue()
+            self.add(perfdata_dispatcher.PerfdataDispatcher,
+                     args=(self.conf, self.queue, self.ack_queue))
+        if self.conf.host_affinity:
+            self.shard_queues = [manager.Queue()
+                                 for i in six.moves.range(conf.workers)]
         self.processor_id = self.add(
-            perfdata_processor.PerfdataProcessor, args=(self.conf, self.queue),
+            perfdata_processor.PerfdataProcessor,
+            args=(self.conf, self.queue, self.shard_queues,
+                  self.ack_queue),
             workers=conf.workers)
+        if self.conf.perfdata_listen:
+            self.add(perfdata_receiver.PerfdataReceiver, args=(self.conf,))
+        if self.conf.metrics_listen:
+            self.add(metrics.MetricsServer, args=(self.conf,))
 
         self.register_hooks(on_reload=self.on_reload)
 
@@ -51,12 +71,19 @@ class GnocchiNagiosServiceManager(cotyledon.ServiceManager):
         # restarted with the new number of workers. This is important because
         # we use the number of worker to declare the capability in tooz and
         # to select the block of metrics to proceed.
+        if (self.shard_queues is not None and
+                len(self.shard_queues) != self.conf.workers):
+            LOG.warning("host_affinity is enabled, the number of workers "
+                        "can't be changed without a restart")
+            self.conf.set_override('workers', len(self.shard_queues))
+            return
         self.reconfigure(self.processor_id,
                          workers=self.conf.workers)
 
     def run(self):
         super(GnocchiNagiosServiceManager, self).run()
-        self.queue.close()
+        if self.queue is not None:
+            self.queue.close()
 
 
 def get_default_workers():
@@ -67,10 +94,12 @@ def get_default_workers():
     return default_workers
 
 
-def prepare_service(args=None, default_config_files=None):
+def prepare_service(args=None, default_config_files=None, cli_opts=None):
     conf = cfg.ConfigOpts()
     # opts.set_defaults()
     log.register_options(conf)
+    if cli_opts:
+        conf.register_cli_opts(cli_opts)
 
     # Register our own Gnocchi options
     for group, options in opts.list_opts():
@@ -21,6 +21,9 @@ from keystoneauth1 import loading as ka_loading
 from oslo_log import log
 import tenacity
 
+from gnocchi_nagios import metrics
+from gnocchi_nagios import utils
+
 LOG = log.getLogger(__name__)
 
 
@@ -35,10 +38,29 @@ def get_gnocchiclient(conf, endpoint_override=None):
                          endpoint_override=endpoint_override)
 
 
+_log_retry = tenacity.after_log(LOG, log.INFO)
+
+
+def _after_retry(*args):
+    metrics.REGISTRY.inc("post_retries_total")
+    return _log_retry(*args)
+
+
+def post_batch_measures(gnocchi, data, create_metrics=True):
+    """Post resources batch measures already encoded in JSON"""
+    headers = {'Content-Type': "application/json",
+               'Accept': "application/json, */*"}
+    encoding = utils.get_content_encoding(data)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    gnocchi.api.post(gnocchi.metric.resources_batch_url, headers=headers,
+                     data=data, params={'create_metrics': create_metrics})
+
+
 retry = tenacity.retry(
     retry=tenacity.retry_if_exception_type(ka_exc.ConnectFailure),
     wait=tenacity.wait_exponential(multiplier=1, max=10),
-    after=tenacity.after_log(LOG, log.INFO)
+    after=_after_retry
 )
 
 
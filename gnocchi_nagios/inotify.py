@@ -0,0 +1,115 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal ctypes binding of the Linux inotify API."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+
+import six
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        # NOTE: raise AttributeError if the libc doesn't have it
+        libc.inotify_init1
+        libc.inotify_add_watch
+        _libc = libc
+    return _libc
+
+
+def is_supported():
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        _get_libc()
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+class Watcher(object):
+    """Watch a directory for files closed after writing or moved into it"""
+
+    def __init__(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        libc = _get_libc()
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        if isinstance(path, six.text_type):
+            path = path.encode(sys.getfilesystemencoding())
+        if libc.inotify_add_watch(self._fd, path, mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, os.strerror(err), path)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        os.close(self._fd)
+
+    def read(self, timeout=None):
+        """Wait for events
+
+        :returns: a tuple of the list of file names of the received events and
+                  a boolean set when the kernel queue overflowed and events
+                  have been lost.
+        """
+        names = []
+        overflow = False
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return names, overflow
+
+        while True:
+            try:
+                buf = os.read(self._fd, _READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = _EVENT.unpack_from(buf, pos)
+                pos += _EVENT.size
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif length:
+                    name = buf[pos:pos + length].rstrip(b'\0')
+                    if not isinstance(name, str):
+                        name = name.decode(sys.getfilesystemencoding())
+                    names.append(name)
+                pos += length
+        return names, overflow
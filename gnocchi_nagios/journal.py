@@ -0,0 +1,100 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+
+from oslo_utils import timeutils
+
+CLAIM = "C"
+ACK = "A"
+
+
+class Journal(object):
+    """Append-only journal of the perfdata files processed by a worker
+
+    A file is claimed when the worker starts reading it, and acknowledged
+    once all its measures have been accepted by Gnocchi.
+
+    Records are flushed to the OS on each write, but fsync() is done at most
+    every fsync_interval seconds. A record lost in a crash can only make a
+    file resubmitted twice, never lost.
+    """
+
+    def __init__(self, path, fsync_interval=1.0):
+        self.path = path
+        self._fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._last_fsync = timeutils.now()
+        self._file = open(self.path, 'a')
+
+    @property
+    def size(self):
+        return self._file.tell()
+
+    @staticmethod
+    def load(path):
+        """Return the sets of claimed and acknowledged file names"""
+        claimed = set()
+        acked = set()
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    # NOTE: ignore a record truncated by a crash
+                    if not line.endswith("\n"):
+                        break
+                    record, name = line[:-1].split(" ", 1)
+                    if record == CLAIM:
+                        claimed.add(name)
+                    elif record == ACK:
+                        acked.add(name)
+        except IOError:
+            pass
+        return claimed, acked
+
+    def claim(self, names):
+        self._write(CLAIM, names)
+
+    def ack(self, names):
+        self._write(ACK, names)
+
+    def _write(self, record, names):
+        with self._lock:
+            self._file.write("".join("%s %s\n" % (record, name)
+                                     for name in names))
+            self._file.flush()
+            now = timeutils.now()
+            if now - self._last_fsync >= self._fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+    def rotate(self, claimed):
+        """Replace the journal by the claims of the files still pending"""
+        with self._lock:
+            tmp = "%s.tmp" % self.path
+            with open(tmp, 'w') as f:
+                f.write("".join("%s %s\n" % (CLAIM, name)
+                                for name in claimed))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            self._file.close()
+            self._file = open(self.path, 'a')
+            self._last_fsync = timeutils.now()
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
@@ -0,0 +1,311 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pipeline instrumentation exposed in the Prometheus text format
+
+Each process counts in its own REGISTRY, and periodically dumps it into
+the metrics directory. The MetricsServer service reads all dumps and
+serves them per worker and aggregated.
+"""
+
+import bisect
+import os
+import socket
+import threading
+
+import cotyledon
+from oslo_log import log
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+import six
+from six.moves import BaseHTTPServer
+
+from gnocchi_nagios import utils
+
+LOG = log.getLogger(__name__)
+
+PREFIX = "gnocchi_nagios_"
+DUMP_INTERVAL = 5
+# NOTE: dumps of workers that are gone are ignored after that
+STALE_DELAY = DUMP_INTERVAL * 6
+
+COUNTERS = {
+    "dispatch_saturations_total": "Times the dispatcher stopped because "
+                                  "the work queue was full",
+    "files_claimed_total": "Perfdata files taken by the workers",
+    "processing_seconds_total": "Time spent by the workers reading "
+                                "perfdata files",
+    "lines_parsed_total": "Perfdata lines parsed",
+    "lines_malformed_total": "Perfdata lines ignored because malformed",
+    "measures_posted_total": "Measures accepted by Gnocchi",
+    "measures_coalesced_total": "Measures removed or aggregated before "
+                                "posting",
+    "post_retries_total": "Gnocchi requests retried",
+    "request_json_bytes_total": "Size of the encoded measures before "
+                                "compression",
+    "request_body_bytes_total": "Size of the measures requests bodies as "
+                                "sent",
+    "resources_created_total": "Gnocchi resources created",
+    "resource_cache_hits_total": "Resources found in the resource cache",
+    "resource_cache_misses_total": "Resources not found in the resource "
+                                   "cache",
+}
+
+GAUGES = {
+    "dispatch_backlog_files": "Perfdata files found and waiting for room "
+                              "in the work queue",
+    "spool_files_waiting": "Perfdata files dispatched and not yet "
+                           "processed",
+}
+
+HISTOGRAMS = {
+    "batch_bytes": ("Size of the measures sent to Gnocchi per request",
+                    (1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                     16777216)),
+    "pass_duration_seconds": ("Duration of the workers runs",
+                              (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60,
+                               120)),
+    "post_latency_seconds": ("Duration of the Gnocchi measures requests",
+                             (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                              2.5, 5, 10)),
+}
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict((name, 0) for name in COUNTERS)
+        self._gauges = dict((name, 0) for name in GAUGES)
+        self._histograms = dict(
+            (name, {"buckets": [0] * (len(buckets) + 1), "sum": 0,
+                    "count": 0})
+            for name, (description, buckets) in six.iteritems(HISTOGRAMS))
+        self._dumper = None
+        self._stop = threading.Event()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def set(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value):
+        index = bisect.bisect_left(HISTOGRAMS[name][1], value)
+        with self._lock:
+            histogram = self._histograms[name]
+            histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": dict(
+                    (name, {"buckets": list(h["buckets"]), "sum": h["sum"],
+                            "count": h["count"]})
+                    for name, h in six.iteritems(self._histograms)),
+            }
+
+    def dump(self, path):
+        tmp = "%s.tmp" % path
+        with open(tmp, 'w') as f:
+            f.write(jsonutils.dumps(self.snapshot()))
+        os.rename(tmp, path)
+
+    def start_dumper(self, directory, name):
+        """Dump the registry into directory every DUMP_INTERVAL seconds"""
+        utils.ensure_directory(directory)
+        path = os.path.join(directory, "%s.json" % name)
+
+        def run():
+            while True:
+                try:
+                    self.dump(path)
+                except Exception:
+                    LOG.error("Fail to dump metrics", exc_info=True)
+                if self._stop.wait(DUMP_INTERVAL):
+                    self.dump(path)
+                    return
+
+        self._stop.clear()
+        self._dumper = threading.Thread(target=run, name="metrics-dumper")
+        self._dumper.daemon = True
+        self._dumper.start()
+
+    def stop_dumper(self):
+        """Write a last dump and stop dumping"""
+        if self._dumper is not None:
+            self._stop.set()
+            self._dumper.join()
+            self._dumper = None
+
+
+REGISTRY = Registry()
+
+
+def load_snapshots(directory):
+    snapshots = {}
+    now = timeutils.utcnow_ts()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return snapshots
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > STALE_DELAY:
+                continue
+            with open(path, 'r') as f:
+                snapshots[name[:-len(".json")]] = jsonutils.loads(f.read())
+        except (IOError, OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+def get_processing_skew(snapshots):
+    """Return how unevenly the work has been distributed to the workers
+
+    It's the difference between the most and the least busy workers
+    divided by the mean busy time, 0 when they have all worked the same
+    time.
+    """
+    busy = [snapshot["counters"].get("processing_seconds_total", 0)
+            for worker, snapshot in six.iteritems(snapshots)
+            if worker.startswith("processor-")]
+    if len(busy) < 2 or not sum(busy):
+        return 0
+    return (max(busy) - min(busy)) / (sum(busy) / float(len(busy)))
+
+
+def render(snapshots):
+    """Render snapshots per worker and aggregated in Prometheus format"""
+    lines = []
+    workers = sorted(snapshots)
+    for kind, metrics in (("counter", COUNTERS), ("gauge", GAUGES)):
+        key = "%ss" % kind
+        for name in sorted(metrics):
+            metric = PREFIX + name
+            lines.append("# HELP %s %s" % (metric, metrics[name]))
+            lines.append("# TYPE %s %s" % (metric, kind))
+            total = 0
+            for worker in workers:
+                value = snapshots[worker][key].get(name, 0)
+                total += value
+                lines.append('%s{worker="%s"} %s' % (
+                    metric, worker, _format_value(value)))
+            lines.append("%s %s" % (metric, _format_value(total)))
+
+    metric = PREFIX + "processing_skew_ratio"
+    lines.append("# HELP %s %s" % (metric, "Spread of the workers busy time "
+                                   "relative to its mean"))
+    lines.append("# TYPE %s gauge" % metric)
+    lines.append("%s %s" % (metric, _format_value(
+        get_processing_skew(snapshots))))
+
+    for name in sorted(HISTOGRAMS):
+        description, bounds = HISTOGRAMS[name]
+        metric = PREFIX + name
+        lines.append("# HELP %s %s" % (metric, description))
+        lines.append("# TYPE %s histogram" % metric)
+        total = {"buckets": [0] * (len(bounds) + 1), "sum": 0, "count": 0}
+        series = []
+        for worker in workers:
+            histogram = snapshots[worker]["histograms"][name]
+            series.append(('worker="%s",' % worker, histogram))
+            total["buckets"] = [a + b for a, b in zip(total["buckets"],
+                                                      histogram["buckets"])]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+        series.append(("", total))
+        for labels, histogram in series:
+            cumulated = 0
+            for bound, count in zip(list(bounds) + ["+Inf"],
+                                    histogram["buckets"]):
+                cumulated += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                lines.append('%s_bucket{%sle="%s"} %d' % (
+                    metric, labels, le, cumulated))
+            lines.append("%s_sum%s %s" % (
+                metric, "{%s}" % labels[:-1] if labels else "",
+                _format_value(histogram["sum"])))
+            lines.append("%s_count%s %d" % (
+                metric, "{%s}" % labels[:-1] if labels else "",
+                histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render(load_snapshots(self.server.metrics_directory))
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug(format, *args)
+
+
+class _UnixHTTPServer(BaseHTTPServer.HTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # NOTE: HTTPServer.server_bind() wants a host and a port
+        utils.remove_stale_socket(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def get_server(listen, directory):
+    """Return an HTTP server for 'host:port' or 'unix:/path' listen"""
+    if listen.startswith("unix:"):
+        server = _UnixHTTPServer(listen[len("unix:"):], _MetricsHandler)
+    else:
+        host, port = listen.rsplit(":", 1)
+        server = BaseHTTPServer.HTTPServer((host, int(port)),
+                                           _MetricsHandler)
+    server.metrics_directory = directory
+    return server
+
+
+class MetricsServer(cotyledon.Service):
+    name = "metrics"
+
+    def __init__(self, worker_id, conf):
+        self._server = get_server(conf.metrics_listen,
+                                  get_directory(conf))
+
+    def run(self):
+        self._server.serve_forever()
+
+    def terminate(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def get_directory(conf):
+    return os.path.join(conf.state_directory, "metrics")
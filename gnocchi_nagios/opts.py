@@ -22,13 +22,137 @@ def list_opts():
                        default='/var/spool/gnocchi-nagios/ready',
                        help='The directory where nagios/icinga writes its '
                        'perfdata file'),
+            cfg.BoolOpt('spool_subdirectories',
+                        default=False,
+                        help='Perfdata files are written into the '
+                        'subdirectories of spool_directory instead of '
+                        'spool_directory itself, ie: ready/00 to ready/ff '
+                        'selected by a hash of the file name, or one '
+                        'subdirectory per Nagios/Icinga instance. Only the '
+                        'subdirectories modified since the previous scan are '
+                        'listed again, which keeps the scanning cheap with '
+                        'large backlogs. spool_watcher inotify is not '
+                        'supported with it.'),
+            cfg.StrOpt('perfdata_listen',
+                       help='Also receive perfdata lines directly, as '
+                       'unix:/path/to/socket or fifo:/path/to/pipe, ie: '
+                       'from the perfdata command of Nagios/Icinga or a '
+                       'broker module. Lines use the same format as the '
+                       'perfdata files and are sent to Gnocchi by a '
+                       'dedicated receiver process. They are posted '
+                       'together once batch_linger, at least one second, '
+                       'has elapsed or the batch is full. A FIFO is created '
+                       'if it doesn\'t exist. '
+                       'Disabled by default.'),
             cfg.IntOpt('workers', min=1,
                        default=1,
                        help='Number of workers for Gnocchi metric daemons. '
                        'By default the available number of CPU is used.'),
+            cfg.StrOpt('dispatch_mode',
+                       default='queue',
+                       choices=('queue', 'claim'),
+                       help='How perfdata files are distributed to the '
+                       'workers. With queue, a dispatcher process scans the '
+                       'spool directory and sends the files to the workers. '
+                       'With claim, there is no dispatcher: each worker '
+                       'scans the spool directory every interval_delay '
+                       'seconds and takes the files that belong to it, '
+                       'selected by a hash of the file name.'),
+            cfg.BoolOpt('host_affinity',
+                        default=False,
+                        help='Send the measures of a host to Gnocchi always '
+                        'from the same worker, selected by a hash of the '
+                        'host name. Lines parsed by another worker are '
+                        'forwarded to it. This keeps the worker caches '
+                        'small and avoids concurrent posts to the same '
+                        'resource. The number of workers can\'t be changed '
+                        'by a reload when enabled.'),
             cfg.IntOpt('file_per_worker_pass',
                        default=100,
                        help='Number of file read by a worker run'),
+            cfg.IntOpt('bytes_per_worker_pass', min=1,
+                       default=32 * 1024 * 1024,
+                       help='Size in bytes of the files read by a worker '
+                       'run. The dispatcher sends the oldest files first, '
+                       'in chunks of file_per_worker_pass files or of this '
+                       'size, whichever comes first, so workers get a '
+                       'similar amount of work.'),
+            cfg.IntOpt('dispatch_queue_size', min=1,
+                       help='Maximum number of chunks of files waiting for a '
+                       'worker in queue dispatch_mode. The workers '
+                       'acknowledge the files they have processed, and the '
+                       'dispatcher stops sending new ones while the queue '
+                       'is full, so the memory used stays bounded when the '
+                       'workers are late, ie: during a Gnocchi outage. By '
+                       'default twice the number of workers.'),
+            cfg.IntOpt('batch_max_measures', min=1,
+                       default=50000,
+                       help='Maximum number of measures a worker keeps in '
+                       'memory before sending them to Gnocchi. Perfdata '
+                       'files are read line by line, so this bounds the '
+                       'worker memory usage whatever the file sizes are.'),
+            cfg.IntOpt('batch_max_bytes', min=1024,
+                       default=8 * 1024 * 1024,
+                       help='Maximum estimated size in bytes of the '
+                       'measures a worker keeps in memory before sending '
+                       'them to Gnocchi.'),
+            cfg.FloatOpt('batch_linger', min=0,
+                         default=0,
+                         help='Maximum number of seconds a worker keeps '
+                         'parsed measures before sending them to Gnocchi. '
+                         'Measures of several passes are sent together, '
+                         'until batch_max_measures, batch_max_bytes or '
+                         'this delay is reached. With 0, measures are sent '
+                         'at the end of each pass.'),
+            cfg.IntOpt('post_max_measures', min=1,
+                       default=10000,
+                       help='Maximum number of measures sent to Gnocchi in '
+                       'one request. Bigger batches are split.'),
+            cfg.IntOpt('post_max_bytes', min=1024,
+                       default=2 * 1024 * 1024,
+                       help='Maximum size in bytes of the measures sent to '
+                       'Gnocchi in one request. Bigger batches are split.'),
+            cfg.IntOpt('post_concurrency', min=1,
+                       default=4,
+                       help='Number of requests a worker sends concurrently '
+                       'to Gnocchi when a batch has been split.'),
+            cfg.StrOpt('post_compression',
+                       default='none',
+                       choices=('none', 'gzip', 'deflate'),
+                       help='Content-Encoding of the measures sent to '
+                       'Gnocchi. It makes the requests several times '
+                       'smaller, for a bit more CPU. Gnocchi doesn\'t decode '
+                       'it by itself, the HTTP server or proxy in front of it '
+                       'must do it, ie: mod_deflate input filter of '
+                       'Apache.'),
+            cfg.IntOpt('post_compression_level', min=1, max=9,
+                       default=6,
+                       help='Compression level of the measures sent to '
+                       'Gnocchi, from 1 (fastest) to 9 (smallest).'),
+            cfg.IntOpt('sender_threads', min=1,
+                       default=1,
+                       help='Number of threads of a worker that send the '
+                       'batches to Gnocchi while the next files are '
+                       'parsed.'),
+            cfg.IntOpt('send_queue_size', min=1,
+                       default=2,
+                       help='Maximum number of parsed batches waiting to be '
+                       'sent. Parsing is paused when it is reached, so the '
+                       'worker memory stays bounded if Gnocchi slows '
+                       'down.'),
+            cfg.BoolOpt('resource_cache_prewarm',
+                        default=True,
+                        help='Load all existing nagios-service resources '
+                        'into the resource cache when a worker starts.'),
+            cfg.IntOpt('resource_cache_size', min=1,
+                       default=100000,
+                       help='Number of resources each worker keeps in its '
+                       'in-process cache, in front of the oslo.cache '
+                       'region.'),
+            cfg.IntOpt('resource_create_concurrency', min=1,
+                       default=8,
+                       help='Number of resources a worker creates '
+                       'concurrently when new hosts show up.'),
             cfg.StrOpt('file_picked_suffix',
                        default="-processed-by-worker-",
                        help='Suffix used when file is currently handled by a '
@@ -37,12 +161,73 @@ def list_opts():
                        default=15,
                        help='Number of seconds between the spool directory '
                        'scanning'),
+            cfg.StrOpt('spool_watcher',
+                       default='polling',
+                       choices=('polling', 'inotify'),
+                       help='How new perfdata files are detected. With '
+                       'inotify (Linux only), files are dispatched as soon '
+                       'as they are written or moved into the spool '
+                       'directory, and the periodic scanning is only used '
+                       'to catch up missed events.'),
             cfg.BoolOpt('resubmit_on_crash',
                         default=False,
                         help='If gnocchi-metricd crashes during a perfdata '
                         'file processing we can\'t really known if the '
                         'Gnocchi have received the data of not. This option '
-                        'allows to resubmit the perfdata a second time.'),
+                        'allows to resubmit the perfdata a second time. '
+                        'The files processed by each worker are tracked in '
+                        'a journal in state_directory.'),
+            cfg.StrOpt('state_directory',
+                       default='/var/lib/gnocchi-nagios',
+                       help='The directory where gnocchi-nagios keeps its '
+                       'state'),
+            cfg.FloatOpt('journal_fsync_interval', min=0,
+                         default=1.0,
+                         help='Maximum number of seconds between two '
+                         'fsync() of the journal. A record lost in a crash '
+                         'can only make a file be resubmitted twice.'),
+            cfg.BoolOpt('spill_on_failure',
+                        default=False,
+                        help='When Gnocchi is unreachable, write the parsed '
+                        'measures to a spill buffer in state_directory '
+                        'instead of retrying, so workers go on with the '
+                        'next files. Spilled measures are replayed once '
+                        'Gnocchi is back.'),
+            cfg.FloatOpt('spill_replay_rate', min=0.1,
+                         default=10,
+                         help='Maximum number of requests per second used by '
+                         'each worker to replay spilled measures.'),
+            cfg.IntOpt('spill_segment_size', min=1024,
+                       default=16 * 1024 * 1024,
+                       help='Size in bytes of the spill buffer segment '
+                       'files.'),
+            cfg.StrOpt('metrics_listen',
+                       help='Where the pipeline metrics are exposed in the '
+                       'Prometheus text format, as host:port or '
+                       'unix:/path/to/socket. Counters are reported per '
+                       'worker and aggregated. Disabled by default.'),
+            cfg.BoolOpt('coalesce_measures',
+                        default=False,
+                        help='Remove the measures of a batch sent several '
+                        'times with the same timestamp and value, like '
+                        'Nagios does on check retries.'),
+            cfg.IntOpt('coalesce_window', min=0,
+                       default=0,
+                       help='Also remove the measures already sent during '
+                       'this number of seconds. 0 disables it.'),
+            cfg.IntOpt('aggregation_granularity', min=0,
+                       default=0,
+                       help='Aggregate the measures of a batch into this '
+                       'number of seconds before sending them, for checks '
+                       'that run more often than the Gnocchi archive policy '
+                       'granularity. The measures of a period split across '
+                       'two batches are aggregated again by Gnocchi. 0 '
+                       'disables it.'),
+            cfg.StrOpt('aggregation_method',
+                       default='mean',
+                       choices=('mean', 'min', 'max', 'last'),
+                       help='How measures are aggregated when '
+                       'aggregation_granularity is set.'),
             cfg.StrOpt('slash_replacement',
                        default='@',
                        help=('replace / with this in resource_id and metric '
@@ -51,6 +236,12 @@ def list_opts():
                        default='::',
                        help=("metric name are built as "
                              "service_name<delim>perfdata_name")),
+            cfg.StrOpt('timestamp_format',
+                       default='iso8601',
+                       choices=('iso8601', 'epoch'),
+                       help='Format of the measure timestamps sent to '
+                       'Gnocchi. epoch sends the Nagios TIMET as a number of '
+                       'seconds, which makes the requests smaller.'),
         ]),
         ('gnocchi', [
             cfg.StrOpt('region-name',
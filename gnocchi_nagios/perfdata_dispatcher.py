@@ -12,67 +12,301 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import os
 import threading
+import time
 
 import cotyledon
 from oslo_log import log
 from oslo_utils import timeutils
 import six
 
+from gnocchi_nagios import inotify
+from gnocchi_nagios import metrics
+from gnocchi_nagios import utils
 
 LOG = log.getLogger(__name__)
 
 
+# NOTE: A directory modified less than this number of seconds before
+# its scan is scanned again, a file may have been added right after the scan
+# without changing the directory mtime
+MTIME_MARGIN = 1
+# NOTE: Maximum number of seconds the dispatcher waits without
+# checking for the shutdown
+WAIT_SLICE = 1
+
+
+def get_queue_size(conf):
+    """Return the maximum number of chunks of files in the work queue"""
+    return conf.dispatch_queue_size or 2 * conf.workers
+
+
 class PerfdataDispatcher(cotyledon.Service):
 
-    def __init__(self, worker_id, conf, queue):
+    def __init__(self, worker_id, conf, queue, ack_queue=None):
         self._conf = conf
         self._queue = queue
+        # NOTE: The processors send back the paths of the files they
+        # have processed
+        self._ack_queue = ack_queue
         self._shutdown = threading.Event()
         self._shutdown_done = threading.Event()
-        self._local_queue = {}
+        # NOTE: The names of the files dispatched and not yet
+        # processed, per spool directory
+        self._inflight = {}
+        # NOTE: The mtime of the spool directories at their last scan
+        self._scanned = {}
+        # NOTE: The oldest new files, waiting for room in the queue
+        self._backlog = collections.deque()
+        self._backlog_paths = set()
+        self._backlog_max_size = (get_queue_size(self._conf) *
+                                  self._conf.file_per_worker_pass)
+        self._saturated = False
 
-        self._seen_flag = True
+        # NOTE: With resubmit_on_crash, each worker recovers its own
+        # files when it starts
+        if not self._conf.resubmit_on_crash:
+            for directory in utils.list_spool_directories(self._conf):
+                for path in os.listdir(directory):
+                    if self._conf.file_picked_suffix in path:
+                        os.remove(os.path.join(directory, path))
 
-        for path in os.listdir(self._conf.spool_directory):
-            if self._conf.file_picked_suffix in path:
-                # FIXME(sileht): implements resubmit_on_crash
-                os.remove((os.path.join(self._conf.spool_directory, path)))
+        self._watcher = None
+        if self._conf.spool_watcher == 'inotify':
+            if self._conf.spool_subdirectories:
+                LOG.warning("inotify can't watch the spool subdirectories, "
+                            "falling back to spool directory polling")
+            elif inotify.is_supported():
+                self._watcher = inotify.Watcher(self._conf.spool_directory)
+            else:
+                LOG.warning("inotify is not available on this platform, "
+                            "falling back to spool directory polling")
 
     def run(self):
+        if self._conf.metrics_listen:
+            metrics.REGISTRY.start_dumper(metrics.get_directory(self._conf),
+                                          "dispatcher")
+        if self._watcher is not None:
+            self._run_watch()
+        else:
+            self._run_poll()
+        self._shutdown_done.set()
+
+    def terminate(self):
+        self._shutdown.set()
+        self._shutdown_done.wait()
+        metrics.REGISTRY.stop_dumper()
+
+    def _run_poll(self):
         while not self._shutdown.is_set():
             with timeutils.StopWatch() as timer:
                 self._run_job()
-                self._shutdown.wait(max(0, self._conf.interval_delay -
-                                        timer.elapsed()))
+                timeout = max(0, self._conf.interval_delay - timer.elapsed())
+                if self._backlog and self._ack_queue is not None:
+                    # NOTE: Go on as soon as workers have room
+                    self._wait_acks(timeout)
+                else:
+                    self._shutdown.wait(timeout)
 
-    def _run_job(self):
-        paths = []
-        for path in os.listdir(self._conf.spool_directory):
+    def _wait_acks(self, timeout):
+        """Wait for acks up to timeout seconds, or until the shutdown"""
+        timer = timeutils.StopWatch(duration=timeout).start()
+        while not self._shutdown.is_set():
+            if self._read_acks(timeout=min(WAIT_SLICE, timer.leftover())):
+                return
+            if timer.expired():
+                return
+
+    def _run_watch(self):
+        # NOTE: The full scan is still done every interval_delay to
+        # reconcile the local queue and catch files we may have missed
+        # (startup, inotify queue overflow, ...)
+        timer = timeutils.StopWatch(duration=0).start()
+        while not self._shutdown.is_set():
+            if timer.expired():
+                self._run_job()
+                timer = timeutils.StopWatch(
+                    duration=self._conf.interval_delay).start()
+
+            names, overflow = self._watcher.read(
+                timeout=min(WAIT_SLICE, timer.leftover()))
+            if overflow:
+                LOG.warning("inotify queue overflow, rescanning the spool "
+                            "directory")
+                self._scanned.clear()
+                timer = timeutils.StopWatch(duration=0).start()
+            self._read_acks()
+            self._run_events(names)
+
+    def _run_events(self, names):
+        directory = self._conf.spool_directory
+        inflight = self._inflight.get(directory, ())
+        entries = []
+        for path in names:
             if self._conf.file_picked_suffix in path:
                 continue
-
-            if path not in self._local_queue:
+            full_path = os.path.join(directory, path)
+            if path not in inflight and full_path not in self._backlog_paths:
                 LOG.debug("new perfdata file: %s" % path)
-                paths.append(os.path.join(self._conf.spool_directory, path))
+                try:
+                    size = os.stat(full_path).st_size
+                except OSError:
+                    # NOTE: the processor will handle it
+                    size = 0
+                entries.append((full_path, size))
+        self._add_to_backlog(entries)
+        self._dispatch()
+
+    def _read_acks(self, timeout=None):
+        """Remove the files processed by the workers from the index
+
+        :param timeout: number of seconds to wait for the first ack.
+        :returns: the number of acks read.
+        """
+        count = 0
+        if self._ack_queue is None:
+            return count
+        while True:
+            try:
+                paths = self._ack_queue.get(block=timeout is not None,
+                                            timeout=timeout)
+            except six.moves.queue.Empty:
+                return count
+            timeout = None
+            count += 1
+            for path in paths:
+                directory, name = os.path.split(path)
+                names = self._inflight.get(directory)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self._inflight[directory]
 
-            # track unprocessed but already send path
-            self._local_queue[path] = self._seen_flag
+    def _add_to_backlog(self, entries):
+        """Add (path, size) entries to the backlog, as long as it's not full
 
-        while paths:
-            size = min(self._conf.file_per_worker_pass, len(paths))
-            self._queue.put(paths[0:size])
-            paths = paths[size:]
+        The directories of the files left out are scanned again later.
+        """
+        room = max(0, self._backlog_max_size - len(self._backlog))
+        for path, size in entries[:room]:
+            self._backlog.append((path, size))
+            self._backlog_paths.add(path)
+        for path, size in entries[room:]:
+            self._scanned.pop(os.path.dirname(path), None)
 
-        # Remove processed files
-        self._local_queue = dict(
-            (path, seen)
-            for path, seen in six.iteritems(self._local_queue)
-            if seen is self._seen_flag
-        )
-        # Invert flag for next pass
-        self._seen_flag = not self._seen_flag
+    def _dispatch(self):
+        """Send the backlog in chunks of files or bytes budget
+
+        It stops when the work queue is full.
+        """
+        while self._backlog:
+            chunk = []
+            chunk_size = 0
+            for path, size in self._backlog:
+                chunk.append(path)
+                chunk_size += size
+                if (len(chunk) >= self._conf.file_per_worker_pass or
+                        chunk_size >= self._conf.bytes_per_worker_pass):
+                    break
+            try:
+                self._queue.put(chunk, block=False)
+            except six.moves.queue.Full:
+                if not self._saturated:
+                    LOG.warning("Workers are late, %d files are waiting for "
+                                "them", len(self._backlog) +
+                                self._get_waiting())
+                    metrics.REGISTRY.inc("dispatch_saturations_total")
+                self._saturated = True
+                return
+            for path in chunk:
+                self._backlog.popleft()
+                self._backlog_paths.discard(path)
+                directory, name = os.path.split(path)
+                self._inflight.setdefault(directory, set()).add(name)
+        if self._saturated:
+            LOG.info("Workers have caught up")
+        self._saturated = False
+
+    def _get_waiting(self):
+        return sum(len(names) for names in self._inflight.values())
+
+    def _scan(self, directory):
+        """Return the (mtime, path, size) of the new files of directory
+
+        The files taken by the processors are removed from the in-flight
+        index.
+        """
+        inflight = self._inflight.get(directory, ())
+        still_inflight = set()
+        entries = []
+        for entry in utils.scandir(directory):
+            path = entry.name
+            if self._conf.file_picked_suffix in path:
+                continue
+            if path in inflight:
+                still_inflight.add(path)
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # NOTE: already taken by a processor
+                continue
+            LOG.debug("new perfdata file: %s" % path)
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+        if still_inflight:
+            self._inflight[directory] = still_inflight
+        else:
+            self._inflight.pop(directory, None)
+        return entries
+
+    def _run_job(self):
+        self._read_acks()
+        # NOTE: The backlog holds the oldest files, the spool
+        # directories are scanned again once it has been dispatched
+        if not self._backlog:
+            self._add_to_backlog(self._scan_directories())
+        self._dispatch()
 
         # Log some stat
-        LOG.info("Currently %d files are waiting.", len(self._local_queue))
+        waiting = self._get_waiting()
+        metrics.REGISTRY.set("spool_files_waiting", waiting)
+        metrics.REGISTRY.set("dispatch_backlog_files", len(self._backlog))
+        LOG.info("Currently %d files are waiting.", waiting)
+
+    def _scan_directories(self):
+        """Return the (path, size) of the new files, the oldest first"""
+        entries = []
+        directories = utils.list_spool_directories(self._conf)
+        for directory in directories:
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            # NOTE: Files are added, and taken by the processors,
+            # with a rename or an unlink that changes the directory mtime
+            if self._scanned.get(directory) == mtime:
+                continue
+            scanned_at = time.time()
+            try:
+                entries.extend(self._scan(directory))
+            except OSError:
+                LOG.warning("Fail to scan %s", directory, exc_info=True)
+                continue
+            if scanned_at - mtime > MTIME_MARGIN:
+                self._scanned[directory] = mtime
+            else:
+                self._scanned.pop(directory, None)
+
+        # Forget the removed directories
+        if len(self._scanned) > len(directories):
+            directories = set(directories)
+            for directory in list(self._scanned):
+                if directory not in directories:
+                    del self._scanned[directory]
+                    self._inflight.pop(directory, None)
+
+        # NOTE: oldest files first, so they don't starve
+        entries.sort()
+        return [(path, size) for mtime, path, size in entries]
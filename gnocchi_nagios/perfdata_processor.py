@@ -24,10 +24,15 @@
 # SERVICESTATE::OK
 # SERVICESTATETYPE::HARD
 
+import collections
 from collections import defaultdict
+from concurrent import futures
 import datetime
+import errno
+import functools
 import hashlib
 import os
+import re
 import threading
 import time
 import uuid
@@ -35,13 +40,18 @@ import uuid
 import cotyledon
 from gnocchiclient import exceptions
 import iso8601
+from keystoneauth1 import exceptions as ka_exc
 import oslo_cache
 from oslo_log import log
-from oslo_serialization import jsonutils
 from oslo_utils import strutils
+from oslo_utils import timeutils
 import six
 
 from gnocchi_nagios import gnocchi_client
+from gnocchi_nagios import journal
+from gnocchi_nagios import metrics
+from gnocchi_nagios import spill
+from gnocchi_nagios import utils
 
 LOG = log.getLogger(__name__)
 
@@ -49,6 +59,53 @@ MANDATORY_ATTRS_COMMON = ('DATATYPE', 'TIMET', 'HOSTNAME')
 MANDATORY_ATTRS_SERVICE = ('SERVICEDESC', 'SERVICEPERFDATA')
 MANDATORY_ATTRS_HOST = ('HOSTPERFDATA',)
 
+TIMESTAMP_CACHE_SIZE = 1024
+PREWARM_PAGE_SIZE = 1000
+FORWARD_CHUNK_SIZE = 1000
+# NOTE: encoded size of a measure with an iso8601 timestamp, ie:
+# {"timestamp":"2016-11-21T11:10:00+00:00","value":9175101.06},
+MEASURE_BYTES = 62
+JOURNAL_MAX_SIZE = 1024 * 1024
+SPILL_CHECK_INTERVAL = 5
+NAMES_CACHE_SIZE = 100000
+COALESCE_CACHE_SIZE = 100000
+
+AGGREGATIONS = {
+    'mean': lambda values: sum(values) / float(len(values)),
+    'min': min,
+    'max': max,
+    'last': lambda values: values[-1],
+}
+
+# NOTE: Same number format as oslo_utils.strutils.string_to_bytes()
+VALUE_RE = re.compile(r"^([-+]?\d*\.?\d+)(.*)$")
+
+
+def _build_units():
+    """Build the unit -> (scale, bits, check_repr) conversion table
+
+    It gives the same results as PerfdataProcessor._convert_value_slow() for
+    all the units it contains.
+    """
+    units = {}
+    for unit in ("", "RPM", "Volts", "degrees_C", "s", "%"):
+        units[unit] = (None, False, False)
+    units["ms"] = (1000.0, False, False)
+    for suffix, bits in (("B", False), ("b", True), ("bit", True)):
+        units[suffix] = (None, bits, False)
+    for prefix, exponent in strutils.UNIT_PREFIX_EXPONENT.items():
+        # NOTE: Only SI knows the lowercase k, IEC knows all others
+        base = 1000 if prefix == "k" else 1024
+        for suffix, bits in (("B", False), ("b", True), ("bit", True)):
+            units[prefix + suffix] = (pow(base, exponent), bits, False)
+        if prefix in ("T", "G", "M", "K"):
+            # Assuming this is bytes...
+            units[prefix] = (pow(base, exponent), False, True)
+    return units
+
+
+UNITS = _build_units()
+
 NAME_ENCODED = __name__.encode('utf-8')
 CACHE_NAMESPACE = uuid.UUID(bytes=hashlib.md5(NAME_ENCODED).digest())
 LOG = log.getLogger(__name__)
@@ -95,15 +152,168 @@ class LockedDefaultDict(defaultdict):
                     key_lock.release()
 
 
+def _unique(values):
+    """Return the values without duplicate, in order"""
+    if len(values) == 1:
+        return values
+    seen = set()
+    return [v for v in values if not (v in seen or seen.add(v))]
+
+
+def _sent_key(resource_id, name, measure):
+    return resource_id, name, measure['timestamp'], measure['value']
+
+
 class MalformedPerfdata(Exception):
     pass
 
 
+class Batch(object):
+    """Measures grouped by resource and metric ready to be posted"""
+
+    def __init__(self):
+        self.measures = {}
+        self.size = 0
+        # NOTE: estimation of the size of the encoded measures
+        self.bytes = 2
+        # NOTE: picked files that have lines in this batch
+        self.paths = set()
+        self.created_at = timeutils.now()
+
+    def get_names(self):
+        return (sorted(os.path.basename(path) for path in self.paths) or
+                ["forwarded lines"])
+
+
+class PendingFiles(object):
+    """Perfdata files being processed
+
+    A file is acknowledged in the journal and removed once it has been fully
+    read and all the batches holding its measures have been sent. If one of
+    them fails, the file is left claimed in the spool directory, to be
+    resubmitted when the worker restarts.
+    """
+
+    def __init__(self, journal=None, on_done=None):
+        self._refs = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._journal = journal
+        self._on_done = on_done
+
+    def open(self, paths):
+        with self._lock:
+            for path in paths:
+                self._refs[path] = 1
+            if self._journal is not None and paths:
+                self._journal.claim(os.path.basename(p) for p in paths)
+
+    def hold(self, paths):
+        with self._lock:
+            for path in paths:
+                self._refs[path] += 1
+
+    def release(self, paths, failed=False):
+        done = []
+        with self._lock:
+            for path in paths:
+                if failed:
+                    self._failed.add(path)
+                self._refs[path] -= 1
+                if not self._refs[path]:
+                    del self._refs[path]
+                    if path in self._failed:
+                        self._failed.discard(path)
+                        LOG.warning("%s not fully sent, keeping it",
+                                    os.path.basename(path))
+                        continue
+                    done.append(path)
+            if self._journal is not None and done:
+                self._journal.ack(os.path.basename(p) for p in done)
+                if self._journal.size > JOURNAL_MAX_SIZE:
+                    self._journal.rotate(os.path.basename(p)
+                                         for p in self._refs)
+        for path in done:
+            os.remove(path)
+        if self._on_done is not None and done:
+            self._on_done(done)
+
+
+class ResourceCache(object):
+    """Known Gnocchi resources and their metrics
+
+    Resources are looked up in an in-process LRU cache first, then in the
+    oslo.cache region shared by the workers. Entries don't expire, the
+    resources deleted from Gnocchi are discarded when a post fails with
+    unknown resources.
+    """
+
+    def __init__(self, region, maxsize):
+        self._local = utils.LRUCache(maxsize)
+        self._local_metrics = utils.LRUCache(maxsize)
+        self._region = region
+
+    @staticmethod
+    def _metrics_key(resource_id):
+        return "%s/metrics" % resource_id
+
+    def __contains__(self, resource_id):
+        if self._local.get(resource_id):
+            return True
+        if self._region.get(resource_id):
+            self._local.set(resource_id, True)
+            return True
+        return False
+
+    def add(self, resource_id):
+        self._local.set(resource_id, True)
+        self._region.set(resource_id, True)
+
+    def discard(self, resource_id):
+        self._local.discard(resource_id)
+        self._region.delete(resource_id)
+        self._local_metrics.discard(resource_id)
+        self._region.delete(self._metrics_key(resource_id))
+
+    def get_metrics(self, resource_id):
+        """Return the names of the metrics known to exist in Gnocchi"""
+        names = self._local_metrics.get(resource_id)
+        if names is None:
+            names = self._region.get(self._metrics_key(resource_id))
+            names = frozenset(names) if names else frozenset()
+            self._local_metrics.set(resource_id, names)
+        return names
+
+    def add_metrics(self, resource_id, names):
+        # NOTE: Names added concurrently may be lost, this only
+        # makes the next batch create them again
+        names = self.get_metrics(resource_id).union(names)
+        self._local_metrics.set(resource_id, names)
+        self._region.set(self._metrics_key(resource_id), sorted(names))
+
+    def prewarm(self, resource_ids):
+        for resource_id in resource_ids:
+            self._local.set(resource_id, True)
+
+
 class PerfdataProcessor(cotyledon.Service):
-    def __init__(self, worker_id, conf, queue):
+    # NOTE: the name of the metrics dump of each worker
+    metrics_name = "processor-%d"
+
+    def __init__(self, worker_id, conf, queue, shard_queues=None,
+                 ack_queue=None):
         self._worker_id = worker_id
         self._conf = conf
         self._queue = queue
+        # NOTE: The paths of the processed files are sent back to
+        # the dispatcher through this queue
+        self._ack_queue = ack_queue
+        self._picked_suffix = "%s%s" % (self._conf.file_picked_suffix,
+                                        self._worker_id)
+        # NOTE: When set, the lines of a host are always sent to
+        # Gnocchi by the same worker, the other workers forward them to it
+        # through these queues.
+        self._shard_queues = shard_queues
         self._shutdown = threading.Event()
         self._shutdown_done = threading.Event()
         self._client = gnocchi_client.get_gnocchiclient(conf)
@@ -112,82 +322,785 @@ class PerfdataProcessor(cotyledon.Service):
         self._cache = oslo_cache.configure_cache_region(
             self._conf, cache_region)
         self._cache.key_mangler = cache_key_mangler
+        self._resources = ResourceCache(self._cache,
+                                        self._conf.resource_cache_size)
+        # NOTE: A perfdata file usually contains thousands of lines
+        # sharing a few TIMET
+        self._timestamps = utils.LRUCache(TIMESTAMP_CACHE_SIZE)
+        # NOTE: The resource ids and metric names built from the
+        # perfdata, the same few thousands show up in each file
+        self._resource_ids = {}
+        self._metric_names = {}
+        self._names_count = 0
+        self._coalesce = (self._conf.coalesce_measures or
+                          self._conf.coalesce_window or
+                          self._conf.aggregation_granularity)
+        self._aggregate = None
+        if self._conf.aggregation_granularity:
+            self._aggregate = AGGREGATIONS[self._conf.aggregation_method]
+        # NOTE: The measures sent recently
+        self._sent_measures = None
+        if self._conf.coalesce_window:
+            self._sent_measures = utils.LRUCache(COALESCE_CACHE_SIZE,
+                                                 self._conf.coalesce_window)
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self._conf.post_concurrency)
+        self._resource_executor = futures.ThreadPoolExecutor(
+            max_workers=self._conf.resource_create_concurrency)
+        self._resource_locks = LockedDefaultDict(threading.Lock)
+        # NOTE: Files are parsed while the previous batches are sent
+        # by the senders threads
+        self._batches = six.moves.queue.Queue(self._conf.send_queue_size)
+        self._senders = []
+        # NOTE: The batch being filled, it can span several passes
+        # when batch_linger is set
+        self._batch = None
+        self._linger = self._conf.batch_linger
+        self._journal = None
+        if self._conf.resubmit_on_crash:
+            utils.ensure_directory(self._conf.state_directory)
+            self._journal = journal.Journal(
+                self._get_state_path("journal"),
+                self._conf.journal_fsync_interval)
+        self._pending = PendingFiles(self._journal, self._ack_picked_files)
+        self._gnocchi_down = threading.Event()
+        self._spill = None
+        if self._conf.spill_on_failure:
+            # NOTE: Connection failures are not retried, measures are
+            # written to the spill buffer and replayed later
+            self._spill = spill.SpillBuffer(
+                self._get_state_path("spill"),
+                self._conf.spill_segment_size)
+            self._spill_position = (None, 0)
+            self._post_part = self._post_measures_or_spill
+        else:
+            self._post_part = gnocchi_client.retry(self._post_measures)
+            self._create_gnocchi_resource = gnocchi_client.retry(
+                self._create_gnocchi_resource)
+
+    def _get_state_path(self, name):
+        return os.path.join(self._conf.state_directory,
+                            "%s-%d" % (name, self._worker_id))
+
+    def _prepare(self):
+        if self._conf.metrics_listen:
+            metrics.REGISTRY.start_dumper(metrics.get_directory(self._conf),
+                                          self.metrics_name % self._worker_id)
+        if self._conf.resource_cache_prewarm:
+            try:
+                self._prewarm_resources()
+            except Exception:
+                LOG.error("Fail to load existing resources into the cache",
+                          exc_info=True)
+
+    def _start_threads(self):
+        self._start_senders()
+        if self._spill is not None:
+            drainer = threading.Thread(target=self._run_spill_drainer,
+                                       name="spill-drainer")
+            drainer.daemon = True
+            drainer.start()
 
     def run(self):
+        self._prepare()
+
+        # NOTE: In queue mode, the dispatcher removes the files
+        # of all workers when they are not resubmitted
+        if self._queue is None or self._journal is not None:
+            self._recover_picked_files()
+        if self._worker_id == 0 and self._spill is not None:
+            self._adopt_orphan_spills()
+
+        self._start_threads()
         while not self._shutdown.is_set():
             try:
-                try:
-                    paths = self._queue.get(block=True, timeout=10)
-                except six.moves.queue.Empty:
-                    # NOTE(sileht): Allow the process to exit gracefully every
-                    # 10 seconds if it don't do anything
-                    continue
-                self._process_perfdata_files(paths)
+                paths = self._get_paths()
+                if paths:
+                    self._process_perfdata_files(paths)
+                if self._shard_queues is not None:
+                    self._process_forwarded_lines()
+                self._flush_batch(force=False)
             except Exception:
                 LOG.error("Unexpected error during measures processing",
                           exc_info=True)
+        try:
+            self._flush_batch()
+        except Exception:
+            LOG.error("Unexpected error during measures processing",
+                      exc_info=True)
+        self._shutdown_done.set()
+
+    def _get_timeout(self, timeout):
+        """Return timeout, or less if the current batch is to be sent"""
+        if self._batch is not None and self._linger:
+            return max(0, min(timeout, self._batch.created_at +
+                              self._linger - timeutils.now()))
+        return timeout
+
+    def _get_paths(self):
+        if self._queue is None:
+            paths = self._list_owned_paths()
+            if not paths:
+                timeout = self._get_timeout(self._conf.interval_delay)
+                if self._shard_queues is not None:
+                    self._process_forwarded_lines(timeout=timeout)
+                else:
+                    self._shutdown.wait(timeout)
+            return paths
+        try:
+            # NOTE: Wake up often when other workers forward us lines
+            return self._queue.get(
+                block=True,
+                timeout=self._get_timeout(1 if self._shard_queues else 10))
+        except six.moves.queue.Empty:
+            # NOTE(sileht): Allow the process to exit gracefully every
+            # 10 seconds if it don't do anything
+            return []
+
+    def _list_owned_paths(self):
+        # NOTE: Without dispatcher, each worker takes the files of
+        # its own shard. The rename done when the file is processed is
+        # atomic, so two workers never process the same file even when the
+        # number of workers changes.
+        paths = []
+        for directory in utils.list_spool_directories(self._conf):
+            for path in os.listdir(directory):
+                if self._conf.file_picked_suffix in path:
+                    continue
+                if (utils.get_shard(path, self._conf.workers) !=
+                        self._worker_id):
+                    continue
+                paths.append(os.path.join(directory, path))
+                if len(paths) >= self._conf.file_per_worker_pass:
+                    return paths
+        return paths
+
+    def _recover_picked_files(self):
+        """Handle the files this worker was processing when it stopped
+
+        Files acknowledged in the journal are removed, the others are
+        processed again if resubmit_on_crash is set. The worker 0 also
+        handles the files of the workers removed by a reload.
+        """
+        if self._worker_id == 0:
+            self._adopt_orphan_files()
+
+        acked = set()
+        if self._journal is not None:
+            acked = journal.Journal.load(self._journal.path)[1]
+            self._journal.rotate([])
+
+        paths = []
+        for directory in utils.list_spool_directories(self._conf):
+            for name in os.listdir(directory):
+                if not name.endswith(self._picked_suffix):
+                    continue
+                path = os.path.join(directory, name)
+                if self._journal is None or name in acked:
+                    os.remove(path)
+                else:
+                    paths.append(path)
+
+        if paths:
+            LOG.info("Resubmitting %d perfdata files", len(paths))
+            self._process_picked_files(paths)
+
+    def _adopt_orphan_files(self):
+        """Take the files picked by workers that no longer exist"""
+        acked = set()
+        journals = []
+        if self._journal is not None:
+            journals = self._list_orphan_states("journal")
+            for path in journals:
+                acked.update(journal.Journal.load(path)[1])
+
+        for directory in utils.list_spool_directories(self._conf):
+            for name in os.listdir(directory):
+                base, sep, worker_id = name.rpartition(
+                    self._conf.file_picked_suffix)
+                if (not sep or not worker_id.isdigit() or
+                        int(worker_id) < self._conf.workers):
+                    continue
+                path = os.path.join(directory, name)
+                if self._journal is None or name in acked:
+                    os.remove(path)
+                else:
+                    LOG.info("Taking %s of the removed worker %s", base,
+                             worker_id)
+                    os.rename(path, os.path.join(
+                        directory, base + self._picked_suffix))
+
+        for path in journals:
+            os.remove(path)
+
+    def _adopt_orphan_spills(self):
+        """Take the spilled measures of workers that no longer exist"""
+        for path in self._list_orphan_states("spill"):
+            LOG.info("Taking the spilled measures of %s", path)
+            self._spill.adopt(path)
+
+    def _list_orphan_states(self, name):
+        """Return the state paths of the workers removed by a reload"""
+        paths = []
+        for filename in os.listdir(self._conf.state_directory):
+            prefix, sep, worker_id = filename.rpartition("-")
+            if (prefix == name and worker_id.isdigit() and
+                    int(worker_id) >= self._conf.workers):
+                paths.append(os.path.join(self._conf.state_directory,
+                                          filename))
+        return paths
+
+    def terminate(self):
+        self._shutdown.set()
+        self._shutdown_done.wait()
+        # NOTE: Send what have already been parsed before exiting
+        for sender in self._senders:
+            self._batches.put(None)
+        for sender in self._senders:
+            sender.join()
+        if self._spill is not None:
+            self._spill.close()
+        metrics.REGISTRY.stop_dumper()
+
+    def _start_senders(self):
+        for i in range(self._conf.sender_threads):
+            sender = threading.Thread(target=self._run_sender,
+                                      name="sender-%d" % i)
+            sender.daemon = True
+            sender.start()
+            self._senders.append(sender)
+
+    def _run_sender(self):
+        while True:
+            item = self._batches.get()
+            if item is None:
+                return
+            paths, batch = item
+            try:
+                self._post_batch(paths, batch.measures)
+            except Exception:
+                LOG.error("Unexpected error during measures posting",
+                          exc_info=True)
+                self._pending.release(batch.paths, failed=True)
+            else:
+                self._pending.release(batch.paths)
+
+    def _send_batch(self, batch):
+        names = batch.get_names()
+        if self._senders:
+            # NOTE: This blocks when the senders are late, so the
+            # memory used by the parsed measures stays bounded
+            self._batches.put((names, batch))
+        else:
+            try:
+                self._post_batch(names, batch.measures)
+            except Exception:
+                self._pending.release(batch.paths, failed=True)
+                raise
+            self._pending.release(batch.paths)
+
+    def _get_batch(self):
+        if self._batch is None:
+            self._batch = Batch()
+        return self._batch
+
+    def _flush_batch(self, force=True):
+        """Send the current batch
+
+        Unless forced, it's sent only if full or older than batch_linger.
+        """
+        batch = self._batch
+        if batch is None:
+            return
+        if not force and not (
+                batch.size >= self._conf.batch_max_measures or
+                batch.bytes >= self._conf.batch_max_bytes or
+                timeutils.now() - batch.created_at >= self._linger):
+            return
+        self._batch = None
+        if batch.size:
+            self._send_batch(batch)
+        else:
+            self._pending.release(batch.paths)
 
     @timeit
     def _process_perfdata_files(self, paths):
-        data = []
+        with timeutils.StopWatch() as timer:
+            self._pick_perfdata_files(paths)
+        metrics.REGISTRY.inc("processing_seconds_total", timer.elapsed())
+        metrics.REGISTRY.observe("pass_duration_seconds", timer.elapsed())
+
+    def _pick_perfdata_files(self, paths):
+        picked = []
+        gone = []
         for path in paths:
-            to_process = "%s%s%s" % (path, self._conf.file_picked_suffix,
-                                     self._worker_id)
-            os.rename(path, to_process)
+            to_process = path + self._picked_suffix
+            try:
+                os.rename(path, to_process)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                LOG.debug("%s already taken by another worker", path)
+                gone.append(path)
+                continue
+            picked.append(to_process)
+        self._ack(gone)
+        self._process_picked_files(picked)
+
+    def _ack(self, paths):
+        if self._ack_queue is not None and paths:
+            self._ack_queue.put(paths)
 
+    def _ack_picked_files(self, paths):
+        self._ack([p[:-len(self._picked_suffix)] for p in paths
+                   if p.endswith(self._picked_suffix)])
+
+    def _process_picked_files(self, paths):
+        metrics.REGISTRY.inc("files_claimed_total", len(paths))
+        self._pending.open(paths)
+        forwarded = {}
+        for path in paths:
             try:
-                with open(to_process, 'r') as f:
-                    for line in f.readlines():
-                        line = line.strip()
-                        if not line:
-                            continue
-                        try:
-                            data.append(self._process_perfdata_line(line))
-                        except MalformedPerfdata as e:
-                            LOG.error(str(e))
+                with open(path, 'r') as f:
+                    for host, service, measures in self._iter_perfdata(f):
+                        if self._shard_queues is not None:
+                            shard = utils.get_shard(host,
+                                                    len(self._shard_queues))
+                            if shard != self._worker_id:
+                                lines = forwarded.setdefault(shard, [])
+                                lines.append((host, service, measures))
+                                if len(lines) >= FORWARD_CHUNK_SIZE:
+                                    self._shard_queues[shard].put(
+                                        forwarded.pop(shard))
+                                continue
+                        batch = self._get_batch()
+                        if path not in batch.paths:
+                            self._pending.hold([path])
+                            batch.paths.add(path)
+                        self._add_to_batch(batch, host, service, measures)
+                        if (batch.size >= self._conf.batch_max_measures or
+                                batch.bytes >= self._conf.batch_max_bytes):
+                            self._flush_batch()
             finally:
-                os.remove(to_process)
+                self._pending.release([path])
 
-        self._post_batch([os.path.basename(p) for p in paths],
-                         self._prepare_batch(data))
+        self._flush_batch(force=not self._linger)
+        for shard, lines in six.iteritems(forwarded):
+            self._shard_queues[shard].put(lines)
+
+    def _process_forwarded_lines(self, timeout=None):
+        queue = self._shard_queues[self._worker_id]
+        while True:
+            try:
+                lines = queue.get(block=timeout is not None, timeout=timeout)
+            except six.moves.queue.Empty:
+                break
+            timeout = None
+            batch = self._get_batch()
+            for host, service, measures in lines:
+                self._add_to_batch(batch, host, service, measures)
+            if (batch.size >= self._conf.batch_max_measures or
+                    batch.bytes >= self._conf.batch_max_bytes):
+                self._flush_batch()
+        self._flush_batch(force=not self._linger)
+
+    def _iter_perfdata(self, lines):
+        parsed = malformed = 0
+        try:
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    result = self._process_perfdata_line(line)
+                except MalformedPerfdata as e:
+                    malformed += 1
+                    LOG.error(str(e))
+                    continue
+                parsed += 1
+                yield result
+        finally:
+            # NOTE: counted once per file, not per line
+            metrics.REGISTRY.inc("lines_parsed_total", parsed)
+            metrics.REGISTRY.inc("lines_malformed_total", malformed)
 
-    @gnocchi_client.retry
     def _post_batch(self, paths, batch):
+        if self._coalesce:
+            self._coalesce_batch(batch)
+            if not batch:
+                return
+        parts = self._encode_batch(batch)
         try:
-            self._client.metric.batch_resources_metrics_measures(
-                batch, create_metrics=True)
-            LOG.info("%s: batched size %d bytes",
-                     paths, len(jsonutils.dumps(batch)))
-        except exceptions.BadRequest as e:
-            if not isinstance(e.message, dict):
-                raise
-            if e.message.get('cause') != 'Unknown resources':
+            # NOTE: Create the new resources first, so the measures
+            # are accepted by Gnocchi the first time
+            if not self._gnocchi_down.is_set():
+                missing = [resource_id for resource_id in batch
+                           if resource_id not in self._resources]
+                metrics.REGISTRY.inc("resource_cache_hits_total",
+                                     len(batch) - len(missing))
+                metrics.REGISTRY.inc("resource_cache_misses_total",
+                                     len(missing))
+                self._create_resources(paths, missing)
+        except ka_exc.ConnectFailure:
+            if self._spill is None:
                 raise
+            self._gnocchi_down.set()
+
+        if len(parts) == 1:
+            posted = [self._post_part(paths, *parts[0])]
+        else:
+            LOG.info("%s: batch split into %d parts", paths, len(parts))
+            jobs = [self._executor.submit(self._post_part, paths, *part)
+                    for part in parts]
+            # NOTE: wait for all parts before raising the first error,
+            # so a failing part doesn't make us resend the succeeded ones
+            errors = [job.exception() for job in jobs]
+            for error in errors:
+                if error is not None:
+                    raise error
+            posted = [job.result() for job in jobs]
+
+        # NOTE: Only what Gnocchi has accepted is known as sent,
+        # the measures of a failed or spilled post must not be coalesced
+        # away when they are resent
+        if self._sent_measures is not None and all(posted):
+            self._set_sent(batch)
+
+    def _coalesce_batch(self, batch):
+        """Remove the duplicate measures of a batch, in place
+
+        With aggregation_granularity set, the timestamps have been rounded,
+        and the measures with the same timestamp are aggregated. Otherwise
+        only the exact duplicates are removed.
+        """
+        removed = 0
+        for resource_id, resource_metrics in six.iteritems(batch):
+            for name, measures in six.iteritems(resource_metrics):
+                if len(measures) > 1:
+                    points = collections.OrderedDict()
+                    for measure in measures:
+                        points.setdefault(measure['timestamp'], []).append(
+                            measure['value'])
+                    if self._aggregate is not None:
+                        coalesced = [{'timestamp': timestamp,
+                                      'value': (values[0] if len(values) == 1
+                                                else self._aggregate(values))}
+                                     for timestamp, values in
+                                     six.iteritems(points)]
+                    else:
+                        coalesced = [{'timestamp': timestamp, 'value': value}
+                                     for timestamp, values in
+                                     six.iteritems(points)
+                                     for value in _unique(values)]
+                else:
+                    coalesced = measures
+
+                if self._sent_measures is not None:
+                    coalesced = [m for m in coalesced
+                                 if not self._sent_measures.get(
+                                     _sent_key(resource_id, name, m))]
+                if len(coalesced) != len(measures):
+                    removed += len(measures) - len(coalesced)
+                    resource_metrics[name] = coalesced
+
+        if not removed:
+            return
+        # NOTE: Drop what is now empty
+        for resource_id in list(batch):
+            resource_metrics = batch[resource_id]
+            for name in [name for name, measures in
+                         six.iteritems(resource_metrics) if not measures]:
+                del resource_metrics[name]
+            if not resource_metrics:
+                del batch[resource_id]
+        metrics.REGISTRY.inc("measures_coalesced_total", removed)
+
+    def _set_sent(self, batch):
+        for resource_id, resource_metrics in six.iteritems(batch):
+            for name, measures in six.iteritems(resource_metrics):
+                for measure in measures:
+                    self._sent_measures.set(
+                        _sent_key(resource_id, name, measure), True)
+
+    def _encode_batch(self, batch):
+        """Encode a batch into JSON parts small enough to be posted
+
+        The parts are compressed when post_compression is set. The encoded
+        parts are reused for the retries and the spill buffer. The size
+        limits apply to the uncompressed parts.
+
+        :returns: a list of (data, measures, new_metrics) tuples, where
+                  measures is the number of measures encoded in data, and
+                  new_metrics the metrics of the part that may not exist
+                  yet in Gnocchi, by resource.
+        """
+        count = sum(len(measures) for resource in six.itervalues(batch)
+                    for measures in six.itervalues(resource))
+        parts = None
+        if count <= self._conf.post_max_measures:
+            data = utils.dump_as_bytes(batch)
+            if len(data) <= self._conf.post_max_bytes:
+                parts = [(data, count, self._get_new_metrics(batch))]
+        if parts is None:
+            parts = []
+            pending = collections.deque(self._split_batch(batch))
+            while pending:
+                part, part_count = pending.popleft()
+                data = utils.dump_as_bytes(part)
+                # NOTE: The split is done on estimated sizes, split
+                # again the parts that are still too big
+                if (len(data) > self._conf.post_max_bytes and
+                        part_count > 1):
+                    pending.extendleft(reversed(self._halve_part(part)))
+                    continue
+                parts.append((data, part_count, self._get_new_metrics(part)))
+
+        raw_size = sum(len(part[0]) for part in parts)
+        if self._conf.post_compression != 'none':
+            parts = [(utils.compress(data, self._conf.post_compression,
+                                     self._conf.post_compression_level),
+                      part_count, new_metrics)
+                     for data, part_count, new_metrics in parts]
+        metrics.REGISTRY.inc("request_json_bytes_total", raw_size)
+        metrics.REGISTRY.inc("request_body_bytes_total",
+                             sum(len(part[0]) for part in parts))
+        return parts
+
+    def _get_new_metrics(self, batch):
+        new_metrics = {}
+        for resource_id, resource_metrics in six.iteritems(batch):
+            known = self._resources.get_metrics(resource_id)
+            names = [name for name in resource_metrics if name not in known]
+            if names:
+                new_metrics[resource_id] = names
+        return new_metrics
+
+    def _split_batch(self, batch):
+        """Split a batch into parts small enough to be posted
+
+        The size of the measures of a metric is estimated from their average
+        encoded size.
 
-            LOG.info("%s: %s/%s resources to create", paths,
-                     len(e.message['detail']), len(batch))
+        :returns: a list of (measures, count) tuples, where count is the
+                  number of measures of the part.
+        """
+        max_measures = self._conf.post_max_measures
+        max_bytes = self._conf.post_max_bytes
+        parts = []
+        part, part_measures, part_bytes = {}, 0, 2
 
-            for detail in e.message['detail']:
-                resource_id = detail['original_resource_id']
+        for resource_id, resource_metrics in six.iteritems(batch):
+            resource_bytes = len(resource_id) + 5
+            for metric, measures in six.iteritems(resource_metrics):
+                measure_bytes = (len(utils.dump_as_bytes(measures)) /
+                                 float(len(measures)))
+                metric_bytes = len(metric) + 5
+                start = 0
+                while start < len(measures):
+                    overhead = metric_bytes
+                    if resource_id not in part:
+                        overhead += resource_bytes
+                    room = min(
+                        max_measures - part_measures,
+                        int((max_bytes - part_bytes - overhead) //
+                            measure_bytes))
+                    if room <= 0 and part_measures:
+                        parts.append((part, part_measures))
+                        part, part_measures, part_bytes = {}, 0, 2
+                        continue
+                    # NOTE: always send at least one measure, even if
+                    # it's bigger than the limit
+                    room = max(1, room)
+                    chunk = measures[start:start + room]
+                    part.setdefault(resource_id, {}).setdefault(
+                        metric, []).extend(chunk)
+                    part_measures += len(chunk)
+                    part_bytes += overhead + len(chunk) * measure_bytes
+                    start += len(chunk)
+
+        if part_measures:
+            parts.append((part, part_measures))
+        return parts
+
+    @staticmethod
+    def _halve_part(part):
+        """Split a part into two parts of about the same number of measures
+
+        :returns: a list of (measures, count) tuples.
+        """
+        count = sum(len(measures) for resource in six.itervalues(part)
+                    for measures in six.itervalues(resource))
+        half = count // 2
+        first, second = {}, {}
+        taken = 0
+        for resource_id, resource_metrics in six.iteritems(part):
+            for metric, measures in six.iteritems(resource_metrics):
+                room = max(0, min(len(measures), half - taken))
+                if room:
+                    resource = first.setdefault(resource_id, {})
+                    resource[metric] = measures[:room]
+                if room < len(measures):
+                    resource = second.setdefault(resource_id, {})
+                    resource[metric] = measures[room:]
+                taken += room
+        return [(first, half), (second, count - half)]
+
+    def _create_resources(self, paths, resource_ids):
+        resource_ids = [resource_id for resource_id in resource_ids
+                        if resource_id not in self._resources]
+        if not resource_ids:
+            return
+        with timeutils.StopWatch() as timer:
+            created = sum(self._resource_executor.map(
+                functools.partial(self._create_resource, paths),
+                resource_ids))
+        metrics.REGISTRY.inc("resources_created_total", created)
+        LOG.info("%s: %d/%d resources created in %.3fs", paths, created,
+                 len(resource_ids), timer.elapsed())
+
+    def _create_resource(self, paths, resource_id):
+        # NOTE: Another batch may be creating the same resource
+        lock = self._resource_locks[resource_id]
+        try:
+            with lock:
+                if resource_id in self._resources:
+                    return False
                 resource = {
                     'id': resource_id,
                     'host': resource_id,
                 }
-                if not self._cache.get(resource_id):
-                    LOG.info("%s: creating resource: %s", paths, resource_id)
-                    try:
-                        self._client.resource.create("nagios-service",
-                                                     resource)
-                    except exceptions.ResourceAlreadyExists:
-                        # Created somewhere else
-                        pass
-                    self._cache.set(resource_id, True)
+                LOG.debug("%s: creating resource: %s", paths, resource_id)
+                try:
+                    self._create_gnocchi_resource(resource)
+                    created = True
+                except exceptions.ResourceAlreadyExists:
+                    # Created somewhere else
+                    created = False
+                self._resources.add(resource_id)
+                return created
+        finally:
+            self._resource_locks.pop(resource_id)
+
+    @gnocchi_client.retry
+    def _prewarm_resources(self):
+        count = 0
+        marker = None
+        while True:
+            resources = self._client.resource.search(
+                resource_type="nagios-service", limit=PREWARM_PAGE_SIZE,
+                marker=marker, sorts=["id:asc"])
+            self._resources.prewarm(r['original_resource_id']
+                                    for r in resources)
+            count += len(resources)
+            if len(resources) < PREWARM_PAGE_SIZE:
+                break
+            marker = resources[-1]['id']
+        LOG.info("%d resources loaded into the cache", count)
+
+    def _create_gnocchi_resource(self, resource):
+        self._client.resource.create("nagios-service", resource)
+
+    def _post_measures_or_spill(self, paths, data, measures,
+                                new_metrics=None):
+        if not self._gnocchi_down.is_set():
+            try:
+                return self._post_measures(paths, data, measures, new_metrics)
+            except ka_exc.ConnectFailure:
+                LOG.warning("Gnocchi is unreachable, spilling measures to "
+                            "disk until it's back")
+                self._gnocchi_down.set()
+        LOG.info("%s: spilled size %d bytes", paths, len(data))
+        self._spill.write(data, measures)
+        return False
+
+    def _run_spill_drainer(self):
+        delay = 1.0 / self._conf.spill_replay_rate
+        while not self._shutdown.is_set():
+            if not self._spill.active:
+                self._shutdown.wait(SPILL_CHECK_INTERVAL)
+                continue
+            try:
+                self._replay_spill(delay)
+            except ka_exc.ConnectFailure:
+                self._shutdown.wait(SPILL_CHECK_INTERVAL)
+            except Exception:
+                LOG.error("Unexpected error during spilled measures replay",
+                          exc_info=True)
+                self._shutdown.wait(SPILL_CHECK_INTERVAL)
+
+    def _replay_spill(self, delay=0):
+        for segment in self._spill.segments():
+            if self._spill_position[0] != segment:
+                self._spill_position = (segment, 0)
+            offset = self._spill_position[1]
+            for next_offset, data, measures in self._spill.read(segment,
+                                                                offset):
+                try:
+                    self._post_measures(["spill"], data, measures)
+                except ka_exc.ConnectFailure:
+                    raise
+                except Exception:
+                    LOG.error("Fail to replay spilled measures, dropping "
+                              "them", exc_info=True)
+                if self._gnocchi_down.is_set():
+                    LOG.info("Gnocchi is back, replaying spilled measures")
+                    self._gnocchi_down.clear()
+                offset = next_offset
+                self._spill_position = (segment, offset)
+                if delay:
+                    self._shutdown.wait(delay)
+            os.remove(segment)
+
+    def _post_measures(self, paths, data, measures, new_metrics=None):
+        """Post encoded measures
+
+        :param new_metrics: the metrics that may not exist yet by resource,
+                            None if unknown. When empty, Gnocchi doesn't
+                            have to check for metrics to create.
+        :returns: True, once the measures have been accepted.
+        """
+        try:
+            self._post_gnocchi_measures(data, measures,
+                                        new_metrics is None or
+                                        bool(new_metrics))
+            LOG.info("%s: batched size %d bytes", paths, len(data))
+        except exceptions.BadRequest as e:
+            if not isinstance(e.message, dict):
+                raise
+            cause = e.message.get('cause')
+            if cause == 'Unknown metrics':
+                # NOTE: They have been deleted since we cached them
+                LOG.info("%s: %d metrics to create", paths,
+                         len(e.message['detail']))
+            elif cause == 'Unknown resources':
+                LOG.info("%s: %d resources to create", paths,
+                         len(e.message['detail']))
+
+                resource_ids = [detail['original_resource_id']
+                                for detail in e.message['detail']]
+                # NOTE: They may have been deleted since we cached
+                # them
+                for resource_id in resource_ids:
+                    self._resources.discard(resource_id)
+                self._create_resources(paths, resource_ids)
+            else:
+                raise
 
             # Must work now !
-            self._client.metric.batch_resources_metrics_measures(
-                batch, create_metrics=True)
-            LOG.info("%s: batched size %d bytes",
-                     paths, len(jsonutils.dumps(batch)))
+            self._post_gnocchi_measures(data, measures, True)
+            LOG.info("%s: batched size %d bytes", paths, len(data))
+
+        for resource_id, names in six.iteritems(new_metrics or {}):
+            self._resources.add_metrics(resource_id, names)
+        return True
+
+    def _post_gnocchi_measures(self, data, measures, create_metrics):
+        with timeutils.StopWatch() as timer:
+            gnocchi_client.post_batch_measures(self._client, data,
+                                               create_metrics)
+        metrics.REGISTRY.observe("post_latency_seconds", timer.elapsed())
+        metrics.REGISTRY.observe("batch_bytes", len(data))
+        metrics.REGISTRY.inc("measures_posted_total", measures)
 
     def _process_perfdata_line(self, line):
         # LOG.debug("Processing line: %s", line)
@@ -221,11 +1134,13 @@ class PerfdataProcessor(cotyledon.Service):
     def _parse_measures(self, timet, perfdata):
         if not perfdata:
             return {}
-        try:
-            timestamp = datetime.datetime.utcfromtimestamp(
-                float(timet)).replace(tzinfo=iso8601.iso8601.UTC).isoformat()
-        except (ValueError, TypeError):
-            raise MalformedPerfdata("TIMET malformated: %s" % perfdata)
+        timestamp = self._timestamps.get(timet)
+        if timestamp is None:
+            try:
+                timestamp = self._convert_timestamp(timet)
+            except (ValueError, TypeError, OverflowError):
+                raise MalformedPerfdata("TIMET malformated: %s" % perfdata)
+            self._timestamps.set(timet, timestamp)
 
         try:
             measures = dict(
@@ -237,18 +1152,75 @@ class PerfdataProcessor(cotyledon.Service):
             raise MalformedPerfdata("PERFDATA malformated: %s" % perfdata)
         return measures
 
-    def _prepare_batch(self, data):
-        batch = {}
-        for host, service, measures in data:
-            resource_id = host.replace('/', self._conf.slash_replacement)
-            r = batch.setdefault(resource_id, {})
-            for metric, value in measures.items():
-                metric = "%s%s%s" % (service, self._conf.metric_delim, metric)
-                metric = metric.replace('/', self._conf.slash_replacement)
-                r.setdefault(metric, []).append(value)
-        return batch
+    def _convert_timestamp(self, timet):
+        epoch = float(timet)
+        if self._conf.aggregation_granularity:
+            epoch -= epoch % self._conf.aggregation_granularity
+        date = datetime.datetime.utcfromtimestamp(epoch)
+        if self._conf.timestamp_format == 'epoch':
+            return int(epoch) if epoch.is_integer() else epoch
+        return date.replace(tzinfo=iso8601.iso8601.UTC).isoformat()
+
+    def _add_to_batch(self, batch, host, service, measures):
+        resource_id = self._resource_ids.get(host)
+        if resource_id is None:
+            resource_id = self._add_name(self._resource_ids, host, host)
+        r = batch.measures.get(resource_id)
+        if r is None:
+            r = batch.measures[resource_id] = {}
+            batch.bytes += len(resource_id) + 6
+        names = self._metric_names.get(service)
+        if names is None:
+            names = self._metric_names.setdefault(service, {})
+        for label, value in measures.items():
+            metric = names.get(label)
+            if metric is None:
+                metric = self._add_name(names, label, "%s%s%s" % (
+                    service, self._conf.metric_delim, label))
+            series = r.get(metric)
+            if series is None:
+                series = r[metric] = []
+                batch.bytes += len(metric) + 6
+            series.append(value)
+        batch.size += len(measures)
+        batch.bytes += len(measures) * MEASURE_BYTES
+
+    def _add_name(self, names, key, name):
+        """Remember the Gnocchi name built for a perfdata name"""
+        if self._names_count >= NAMES_CACHE_SIZE:
+            # NOTE: Just start again, the names are usually stable,
+            # this only happens when hosts or services are renamed a lot
+            self._resource_ids.clear()
+            self._metric_names.clear()
+            self._names_count = 0
+        name = name.replace('/', self._conf.slash_replacement)
+        # NOTE: Python 2 only interns bytes
+        if isinstance(name, str):
+            name = six.moves.intern(name)
+        names[key] = name
+        self._names_count += 1
+        return name
 
     def _convert_value(self, v):
+        v = v.strip()
+        match = VALUE_RE.match(v)
+        if match:
+            number, unit = match.groups()
+            conversion = UNITS.get(unit)
+            if conversion is not None:
+                scale, bits, check_repr = conversion
+                value = float(number)
+                # NOTE: the slow path reparses the repr() of the value
+                # for these units, it fails for the exponent notation.
+                if not check_repr or 'e' not in repr(value):
+                    if bits:
+                        value /= 8
+                    if scale is not None:
+                        value = value * scale
+                    return value
+        return self._convert_value_slow(v)
+
+    def _convert_value_slow(self, v):
         # This currently takes care only on bytes
         try:
             v = v.strip()
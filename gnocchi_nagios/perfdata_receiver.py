@@ -0,0 +1,193 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import select
+import socket
+import stat
+
+from oslo_log import log
+import six
+
+from gnocchi_nagios import metrics
+from gnocchi_nagios import perfdata_processor
+from gnocchi_nagios import utils
+
+LOG = log.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+# NOTE: A client sending garbage without newline can't make the
+# receiver use all the memory
+MAX_LINE_SIZE = 1024 * 1024
+# NOTE: Lines usually come one by one, they are kept at least this
+# number of seconds to be posted together
+MIN_LINGER = 1
+
+
+class Fifo(object):
+    """Named pipe read like a socket connection"""
+
+    def __init__(self, path):
+        try:
+            os.mkfifo(path, 0o660)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            raise ValueError("%s is not a named pipe" % path)
+        self._fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # NOTE: The pipe is always readable and read() returns
+        # nothing once the writers have closed it, unless we keep it open for
+        # writing too
+        self._writer = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._fd
+
+    def recv(self, size):
+        try:
+            return os.read(self._fd, size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
+
+    def close(self):
+        os.close(self._writer)
+        os.close(self._fd)
+
+
+def get_listener(listen):
+    """Return a listening socket for 'unix:/path' or a Fifo for 'fifo:/path'"""
+    if listen.startswith("fifo:"):
+        return Fifo(listen[len("fifo:"):])
+    elif listen.startswith("unix:"):
+        path = listen[len("unix:"):]
+        utils.remove_stale_socket(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(128)
+        return sock
+    raise ValueError("perfdata_listen must start with unix: or fifo:")
+
+
+class PerfdataReceiver(perfdata_processor.PerfdataProcessor):
+    """Process the perfdata lines received on a UNIX socket or a FIFO
+
+    Lines are parsed and sent to Gnocchi like the ones of the perfdata
+    files, without the spool directory round-trip.
+    """
+
+    metrics_name = "receiver-%d"
+
+    def __init__(self, worker_id, conf):
+        super(PerfdataReceiver, self).__init__(worker_id, conf, None)
+        self._linger = max(self._linger, MIN_LINGER)
+        self._listener = get_listener(conf.perfdata_listen)
+        # NOTE: The incomplete last line received from each source
+        self._buffers = {}
+        # NOTE: The sources sending a line too long, ignored until
+        # the next newline
+        self._discarding = set()
+        if isinstance(self._listener, Fifo):
+            self._buffers[self._listener] = b""
+
+    def _get_state_path(self, name):
+        return super(PerfdataReceiver, self)._get_state_path(
+            "receiver-%s" % name)
+
+    def run(self):
+        self._prepare()
+        self._start_threads()
+        while not self._shutdown.is_set():
+            try:
+                self._receive(timeout=self._get_timeout(1))
+                self._flush_batch(force=False)
+            except Exception:
+                LOG.error("Unexpected error during measures processing",
+                          exc_info=True)
+        for source in list(self._buffers):
+            self._close(source)
+        self._listener.close()
+        try:
+            self._flush_batch()
+        except Exception:
+            LOG.error("Unexpected error during measures processing",
+                      exc_info=True)
+        self._shutdown_done.set()
+
+    def _receive(self, timeout):
+        sources = set(self._buffers)
+        sources.add(self._listener)
+        readable = select.select(list(sources), [], [], timeout)[0]
+        for source in readable:
+            if source not in self._buffers:
+                conn = source.accept()[0]
+                conn.setblocking(False)
+                self._buffers[conn] = b""
+                continue
+
+            try:
+                data = source.recv(READ_SIZE)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                LOG.warning("Fail to read perfdata: %s", e)
+                data = b""
+            if data is None:
+                continue
+            elif not data:
+                self._close(source)
+                continue
+
+            lines = (self._buffers[source] + data).split(b"\n")
+            rest = lines.pop()
+            if source in self._discarding:
+                if lines:
+                    # NOTE: the end of the line too long
+                    lines.pop(0)
+                    self._discarding.discard(source)
+                else:
+                    rest = b""
+            if len(rest) > MAX_LINE_SIZE:
+                LOG.error("Perfdata line longer than %d bytes, ignoring it",
+                          MAX_LINE_SIZE)
+                metrics.REGISTRY.inc("lines_malformed_total")
+                rest = b""
+                self._discarding.add(source)
+            self._buffers[source] = rest
+            self._process_lines(lines)
+
+    def _close(self, source):
+        """Process the last line of a source and close it"""
+        rest = self._buffers.pop(source)
+        if source in self._discarding:
+            self._discarding.discard(source)
+        else:
+            self._process_lines([rest])
+        if source is not self._listener:
+            source.close()
+
+    def _process_lines(self, lines):
+        if six.PY3:
+            lines = [line.decode("utf-8", "replace") for line in lines]
+        for host, service, measures in self._iter_perfdata(lines):
+            batch = self._get_batch()
+            self._add_to_batch(batch, host, service, measures)
+            # NOTE: This blocks when the senders are late, then the
+            # clients are blocked too by the socket or pipe buffers
+            if (batch.size >= self._conf.batch_max_measures or
+                    batch.bytes >= self._conf.batch_max_bytes):
+                self._flush_batch()
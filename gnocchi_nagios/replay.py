@@ -0,0 +1,250 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Import archived perfdata files into Gnocchi
+
+Files are parsed and posted by a pool of processes with the
+PerfdataProcessor code. The imported files, and members of tar archives,
+are recorded in a checkpoint in state_directory, so an interrupted import
+is resumed where it stopped.
+"""
+
+import bz2
+import contextlib
+import gzip
+import io
+import multiprocessing
+import os
+import sys
+import tarfile
+import time
+
+from oslo_config import cfg
+from oslo_log import log
+from oslo_utils import importutils
+import six
+
+from gnocchi_nagios import cli
+from gnocchi_nagios import gnocchi_client
+from gnocchi_nagios import journal
+from gnocchi_nagios import perfdata_processor
+from gnocchi_nagios import utils
+
+LOG = log.getLogger(__name__)
+
+# NOTE: lzma is only available on Python >= 3.3
+lzma = importutils.try_import('lzma')
+
+CHECKPOINT = "replay-checkpoint"
+# NOTE: Number of lines between two updates of the lines counter
+REPORT_LINES = 1000
+
+CLI_OPTS = [
+    cfg.MultiStrOpt('path', positional=True, required=False,
+                    help='Perfdata files, directories or archives to '
+                    'import. Files compressed with gzip, bzip2 or xz and tar '
+                    'archives are read directly.'),
+    cfg.IntOpt('processes', min=1,
+               help='Number of processes parsing and posting the measures. '
+               'By default the available number of CPU is used.'),
+    cfg.FloatOpt('rate', min=0,
+                 default=0,
+                 help='Maximum number of perfdata lines imported per '
+                 'second. 0 means no limit.'),
+    cfg.IntOpt('progress-interval', min=1,
+               default=10,
+               help='Number of seconds between two progress reports.'),
+    cfg.BoolOpt('restart',
+                default=False,
+                help='Ignore the checkpoint of the previous import and '
+                'import all files again.'),
+]
+
+# NOTE: The state of each process of the pool
+_processor = None
+_checkpoint = None
+_done = None
+_lines = None
+_started_at = None
+_rate = None
+
+
+def list_files(paths):
+    """Return the files of paths, directories are walked"""
+    files = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names))
+    return files
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    elif path.endswith(".bz2"):
+        return bz2.BZ2File(path, 'rb')
+    elif path.endswith(".xz") and lzma is not None:
+        return lzma.open(path, 'rb')
+    return io.open(path, 'rb')
+
+
+def _init_worker(conf, checkpoint, done, lines, started_at):
+    global _processor, _checkpoint, _done, _lines, _started_at, _rate
+    _processor = perfdata_processor.PerfdataProcessor(0, conf, None)
+    if conf.resource_cache_prewarm:
+        try:
+            _processor._prewarm_resources()
+        except Exception:
+            LOG.error("Fail to load existing resources into the cache",
+                      exc_info=True)
+    # NOTE: Each process appends to the checkpoint, records are
+    # small enough to be written atomically
+    _checkpoint = journal.Journal(checkpoint, conf.journal_fsync_interval)
+    _done = done
+    _lines = lines
+    _started_at = started_at
+    _rate = conf.rate
+
+
+def _count_lines(count):
+    """Add count to the lines imported, and wait to honor the rate"""
+    with _lines.get_lock():
+        _lines.value += count
+        total = _lines.value
+    if _rate:
+        delay = total / _rate - (time.time() - _started_at)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _replay_lines(f):
+    lines = f
+    if six.PY3:
+        lines = (line.decode("utf-8", "replace") for line in f)
+    count = 0
+    for host, service, measures in _processor._iter_perfdata(lines):
+        batch = _processor._get_batch()
+        _processor._add_to_batch(batch, host, service, measures)
+        if (batch.size >= _processor._conf.batch_max_measures or
+                batch.bytes >= _processor._conf.batch_max_bytes):
+            _processor._flush_batch()
+        count += 1
+        if count >= REPORT_LINES:
+            _count_lines(count)
+            count = 0
+    _processor._flush_batch()
+    _count_lines(count)
+
+
+def replay_file(path):
+    """Import a file, or the members of a tar archive
+
+    :returns: a tuple of the path and a boolean set when it succeeded.
+    """
+    try:
+        if tarfile.is_tarfile(path):
+            with contextlib.closing(tarfile.open(path, 'r|*')) as tar:
+                for member in tar:
+                    name = "%s:%s" % (path, member.name)
+                    if not member.isfile() or name in _done:
+                        continue
+                    _replay_lines(tar.extractfile(member))
+                    _checkpoint.ack([name])
+        else:
+            with contextlib.closing(_open(path)) as f:
+                _replay_lines(f)
+        _checkpoint.ack([path])
+    except Exception:
+        LOG.error("Fail to import %s", path, exc_info=True)
+        return path, False
+    return path, True
+
+
+def replay(conf):
+    """Import the files of conf.path
+
+    :returns: the number of files that failed to be imported.
+    """
+    utils.ensure_directory(conf.state_directory)
+    checkpoint = os.path.join(conf.state_directory, CHECKPOINT)
+    if conf.restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    done = journal.Journal.load(checkpoint)[1]
+    files = list_files(conf.path)
+    paths = [path for path in files if path not in done]
+    if len(paths) < len(files):
+        LOG.info("Resuming the import, %d/%d files left", len(paths),
+                 len(files))
+
+    lines = multiprocessing.Value('d', 0)
+    started_at = time.time()
+    pool = multiprocessing.Pool(
+        conf.processes or cli.get_default_workers(), _init_worker,
+        (conf, checkpoint, done, lines, started_at))
+    failed = 0
+    try:
+        results = pool.imap_unordered(replay_file, paths)
+        imported = 0
+        last_lines = 0
+        last_report = started_at
+        while imported + failed < len(paths):
+            try:
+                path, succeeded = results.next(
+                    timeout=conf.progress_interval)
+            except multiprocessing.TimeoutError:
+                pass
+            else:
+                if succeeded:
+                    imported += 1
+                else:
+                    failed += 1
+            now = time.time()
+            if now - last_report >= conf.progress_interval:
+                LOG.info("%d/%d files imported, %d failed, %d lines, "
+                         "%.0f lines/s", imported, len(paths), failed,
+                         lines.value, (lines.value - last_lines) /
+                         (now - last_report))
+                last_lines = lines.value
+                last_report = now
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = time.time() - started_at
+    LOG.info("%d files imported, %d failed, %d lines in %.1fs, %.0f lines/s",
+             len(paths) - failed, failed, lines.value, elapsed,
+             lines.value / elapsed if elapsed else 0)
+    return failed
+
+
+def main():
+    conf = cli.prepare_service(cli_opts=CLI_OPTS)
+    if not conf.path:
+        LOG.error("No perfdata files to import")
+        sys.exit(2)
+    # NOTE: Errors are reported and the files are imported again on
+    # the next run, the daemon spill buffer and journal are not used
+    conf.set_override('spill_on_failure', False)
+    conf.set_override('resubmit_on_crash', False)
+    gnocchi_client.update_gnocchi_resource_type(conf)
+    if replay(conf):
+        sys.exit(1)
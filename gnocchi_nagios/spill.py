@@ -0,0 +1,119 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import threading
+
+from gnocchi_nagios import utils
+
+# NOTE: data length and number of measures
+HEADER = struct.Struct(">II")
+SEGMENT_PREFIX = "segment-"
+
+
+class SpillBuffer(object):
+    """On-disk buffer of measures that can't be sent to Gnocchi
+
+    Encoded measures are appended as length-prefixed records to segment
+    files.
+    Once a segment reaches segment_size bytes, it's closed and a new one is
+    started. Closed segments are replayed then removed by the caller.
+    """
+
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self._segment_size = segment_size
+        self._lock = threading.Lock()
+        utils.ensure_directory(self.directory)
+        segments = self._list_segments()
+        self._next_id = (int(segments[-1][len(SEGMENT_PREFIX):]) + 1
+                         if segments else 0)
+        self._current = None
+        # NOTE: Segments left by a previous run need to be replayed
+        self.active = bool(segments)
+
+    def _list_segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith(SEGMENT_PREFIX))
+
+    def _next_segment_path(self):
+        path = os.path.join(self.directory, "%s%020d" % (SEGMENT_PREFIX,
+                                                         self._next_id))
+        self._next_id += 1
+        return path
+
+    def adopt(self, directory):
+        """Move the segments of another buffer into this one
+
+        The emptied directory is removed.
+        """
+        with self._lock:
+            for name in sorted(os.listdir(directory)):
+                if name.startswith(SEGMENT_PREFIX):
+                    os.rename(os.path.join(directory, name),
+                              self._next_segment_path())
+                    self.active = True
+            os.rmdir(directory)
+
+    def _close_current(self):
+        if self._current is not None:
+            self._current.flush()
+            os.fsync(self._current.fileno())
+            self._current.close()
+            self._current = None
+
+    def write(self, data, measures):
+        with self._lock:
+            self.active = True
+            if self._current is None:
+                self._current = open(self._next_segment_path(), 'ab')
+            self._current.write(HEADER.pack(len(data), measures) + data)
+            self._current.flush()
+            if self._current.tell() >= self._segment_size:
+                self._close_current()
+
+    def segments(self):
+        """Close the current segment and return the path of all segments
+
+        When there is nothing left to replay, the buffer becomes inactive.
+        """
+        with self._lock:
+            self._close_current()
+            segments = [os.path.join(self.directory, name)
+                        for name in self._list_segments()]
+            if not segments:
+                self.active = False
+            return segments
+
+    @staticmethod
+    def read(path, offset=0):
+        """Yield the (next offset, data, measures) of a segment records"""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, measures = HEADER.unpack(header)
+                data = f.read(length)
+                # NOTE: ignore a record truncated by a crash
+                if len(data) < length:
+                    return
+                offset += HEADER.size + length
+                yield offset, data, measures
+
+    def close(self):
+        with self._lock:
+            self._close_current()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Synthetic perfdata and a fake Gnocchi server for tests and benchmarks"""
+
+import itertools
+import os
+import threading
+import time
+import zlib
+
+from oslo_serialization import jsonutils
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+
+SERVICE_LINE = ("DATATYPE::SERVICEPERFDATA\tTIMET::%(timet)d\t"
+                "HOSTNAME::%(host)s\tSERVICEDESC::%(service)s\t"
+                "SERVICEPERFDATA::%(perfdata)s\t"
+                "SERVICECHECKCOMMAND::check_mk-%(service)s\tHOSTSTATE::UP\t"
+                "HOSTSTATETYPE::HARD\tSERVICESTATE::OK\t"
+                "SERVICESTATETYPE::HARD\n")
+HOST_LINE = ("DATATYPE::HOSTPERFDATA\tTIMET::%(timet)d\t"
+             "HOSTNAME::%(host)s\t"
+             "HOSTPERFDATA::rta=0.%(value)03dms;200.000;500.000;0; pl=0%%;"
+             "80;100;; rtmax=0.%(value)03dms;;;; rtmin=0.%(value)03dms;;;;\t"
+             "HOSTCHECKCOMMAND::check-mk-ping\tHOSTSTATE::UP\t"
+             "HOSTSTATETYPE::HARD\n")
+UNITS = ("", "MB", "ms", "%", "s", "KB")
+
+
+def generate_perfdata(hosts, services, metrics, timet, start=0):
+    """Yield the perfdata line of each host and each of its services
+
+    Each host sends a HOSTPERFDATA line and a SERVICEPERFDATA line per
+    service, with metrics measures each.
+    """
+    for h in range(hosts):
+        host = "host-%d.example.com" % h
+        yield HOST_LINE % {"timet": timet, "host": host,
+                           "value": (start + h) % 1000}
+        for s in range(services):
+            perfdata = " ".join(
+                "metric_%d=%d.%d%s;80;90;0;100" % (
+                    m, (start + h + s + m) % 100, m,
+                    UNITS[(s + m) % len(UNITS)])
+                for m in range(metrics))
+            yield SERVICE_LINE % {"timet": timet, "host": host,
+                                  "service": "service_%d" % s,
+                                  "perfdata": perfdata}
+
+
+def generate_spool(directory, files, hosts, services, metrics,
+                   lines_per_file=1000, timet=None):
+    """Write perfdata files like Nagios/Icinga process_perfdata does
+
+    Checks are cycled over all hosts and services, and the timestamp is
+    increased by one minute on each cycle.
+
+    :returns: the number of lines and the number of measures written.
+    """
+    timet = int(time.time()) if timet is None else timet
+
+    def lines():
+        for cycle in itertools.count():
+            for line in generate_perfdata(hosts, services, metrics,
+                                          timet + cycle * 60, cycle):
+                yield line
+
+    source = lines()
+    measures = 0
+    for i in range(files):
+        path = os.path.join(directory, "service-perfdata.%d.%06d" % (
+            timet, i))
+        with open(path, 'w') as f:
+            for line in itertools.islice(source, lines_per_file):
+                f.write(line)
+                measures += (4 if line.startswith("DATATYPE::HOSTPERFDATA")
+                             else metrics)
+    return files * lines_per_file, measures
+
+
+class _FakeGnocchiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, code, body=None):
+        data = b"" if body is None else jsonutils.dump_as_bytes(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return None
+        data = self.rfile.read(length)
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            data = zlib.decompress(data)
+        return jsonutils.loads(data.decode("utf-8"))
+
+    def do_GET(self):
+        if self.path.startswith("/v1/resource_type/"):
+            self._reply(200, {"name": self.path.rsplit("/", 1)[-1],
+                              "attributes": {}})
+        else:
+            self._reply(404, {"description": "Not found"})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        # NOTE: the body must be read to keep the connection usable
+        body = self._read_body()
+        gnocchi = self.server.gnocchi
+        if gnocchi.delay:
+            time.sleep(gnocchi.delay)
+        if url.path == "/v1/batch/resources/metrics/measures":
+            create_metrics = urlparse.parse_qs(url.query).get(
+                "create_metrics", ["false"])[0].lower() == "true"
+            self._reply(*gnocchi.post_measures(body, create_metrics))
+        elif url.path.startswith("/v1/resource/"):
+            self._reply(*gnocchi.create_resource(body))
+        elif url.path.startswith("/v1/search/resource/"):
+            self._reply(200, gnocchi.search_resources(
+                urlparse.parse_qs(url.query)))
+        else:
+            self._reply(404, {"description": "Not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeGnocchi(object):
+    """Just enough of the Gnocchi API for gnocchi-nagios
+
+    Measures are only counted. Measures of unknown resources are refused
+    with the 'Unknown resources' error, and measures of unknown metrics with
+    the 'Unknown metrics' error when create_metrics is not set, like Gnocchi
+    does.
+
+    :param delay: seconds added to each POST to simulate a loaded Gnocchi.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.resources = set()
+        self.metrics = {}
+        self.measures = 0
+        self.requests = 0
+        self.create_metrics_requests = 0
+        self.first_measures_at = None
+        self.last_measures_at = None
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0),
+                                            _FakeGnocchiHandler)
+        self._server.gnocchi = self
+        self.url = "http://127.0.0.1:%d" % self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def post_measures(self, body, create_metrics):
+        with self.lock:
+            unknown = [resource_id for resource_id in body
+                       if resource_id not in self.resources]
+            if unknown:
+                return 400, {"description": {
+                    "cause": "Unknown resources",
+                    "detail": [{"resource_id": resource_id,
+                                "original_resource_id": resource_id}
+                               for resource_id in unknown]}}
+            unknown = ["%s/%s" % (resource_id, name)
+                       for resource_id, metrics in body.items()
+                       for name in metrics
+                       if name not in self.metrics.get(resource_id, ())]
+            if unknown and not create_metrics:
+                return 400, {"description": {"cause": "Unknown metrics",
+                                             "detail": unknown}}
+            for resource_id, metrics in body.items():
+                self.metrics.setdefault(resource_id, set()).update(metrics)
+            self.requests += 1
+            if create_metrics:
+                self.create_metrics_requests += 1
+            self.measures += sum(len(measures)
+                                 for metrics in body.values()
+                                 for measures in metrics.values())
+            self.last_measures_at = time.time()
+            if self.first_measures_at is None:
+                self.first_measures_at = self.last_measures_at
+        return 202, None
+
+    def create_resource(self, body):
+        with self.lock:
+            if body["id"] in self.resources:
+                return 409, {"description": "Resource %s already exists" %
+                             body["id"]}
+            self.resources.add(body["id"])
+            self.metrics[body["id"]] = set()
+        return 201, dict(body, original_resource_id=body["id"])
+
+    def search_resources(self, query):
+        limit = int(query.get("limit", [1000])[0])
+        marker = query.get("marker", [None])[0]
+        with self.lock:
+            ids = sorted(self.resources)
+        if marker is not None:
+            ids = [i for i in ids if i > marker]
+        return [{"id": i, "original_resource_id": i} for i in ids[:limit]]
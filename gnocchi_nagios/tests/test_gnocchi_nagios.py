@@ -12,18 +12,35 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import gzip
 import multiprocessing
 import os
+import socket
 import subprocess
+import tarfile
+import threading
 import time
 
 import fixtures
+from keystoneauth1 import exceptions as ka_exc
+import mock
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+import six
 
 from gnocchi_nagios import cli
 from gnocchi_nagios import gnocchi_client
+from gnocchi_nagios import inotify
+from gnocchi_nagios import journal
+from gnocchi_nagios import metrics
 from gnocchi_nagios import perfdata_dispatcher
 from gnocchi_nagios import perfdata_processor
+from gnocchi_nagios import perfdata_receiver
+from gnocchi_nagios import replay
+from gnocchi_nagios import spill
+from gnocchi_nagios import utils
 from gnocchi_nagios.tests import base
+from gnocchi_nagios.tests import bench
 
 
 PERFDATA_SERVICE = """
@@ -100,7 +117,7 @@ endpoint = "%s"
         # The queues must be fill
         p._run_job()
         self.assertEqual(1, queue.qsize())
-        self.assertEqual(2, len(p._local_queue))
+        self.assertEqual(2, p._get_waiting())
 
         # Processors takes files, ensure we have the both files returned
         paths = queue.get()
@@ -110,7 +127,7 @@ endpoint = "%s"
         # and the local tracking is still OK
         p._run_job()
         self.assertEqual(0, queue.qsize())
-        self.assertEqual(2, len(p._local_queue))
+        self.assertEqual(2, p._get_waiting())
 
         # Processors process files
         os.rename(f1, p1)
@@ -120,7 +137,7 @@ endpoint = "%s"
         # and the local tracking should be gone
         p._run_job()
         self.assertEqual(0, queue.qsize())
-        self.assertEqual(0, len(p._local_queue))
+        self.assertEqual(0, p._get_waiting())
 
         # Nagios put new files
         self.touch(f3)
@@ -129,7 +146,7 @@ endpoint = "%s"
         # New stuffs should be there
         p._run_job()
         self.assertEqual(1, queue.qsize())
-        self.assertEqual(2, len(p._local_queue))
+        self.assertEqual(2, p._get_waiting())
 
         # Processors takes files, ensure we have the both files returned
         paths = queue.get()
@@ -144,7 +161,178 @@ endpoint = "%s"
         # We have nothing to do anymore
         p._run_job()
         self.assertEqual(0, queue.qsize())
-        self.assertEqual(0, len(p._local_queue))
+        self.assertEqual(0, p._get_waiting())
+
+    def test_dispatcher_inotify(self):
+        if not inotify.is_supported():
+            self.skipTest("inotify is not supported")
+        self.conf.set_override('spool_watcher', 'inotify')
+        queue = multiprocessing.Manager().Queue()
+        p = perfdata_dispatcher.PerfdataDispatcher(0, self.conf, queue)
+        self.addCleanup(p._watcher.close)
+
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        src = "%s/%s" % (self.useFixture(fixtures.TempDir()).path,
+                         "service-perfdata")
+
+        # Nagios moves a file into the spool
+        self.touch(src)
+        os.rename(src, f1)
+
+        # It is dispatched without scanning the spool
+        names, overflow = p._watcher.read(timeout=5)
+        self.assertEqual(["service-perfdata.1479712710"], names)
+        self.assertFalse(overflow)
+        p._run_events(names)
+        self.assertEqual([f1], queue.get())
+        self.assertEqual(1, p._get_waiting())
+
+        # The reconciliation scan doesn't dispatch it again
+        p._run_job()
+        self.assertEqual(0, queue.qsize())
+
+    def test_dispatcher_subdirectories(self):
+        self.conf.set_override('spool_subdirectories', True)
+        queue = multiprocessing.Manager().Queue()
+        p = perfdata_dispatcher.PerfdataDispatcher(0, self.conf, queue)
+
+        d1 = "%s/%s" % (self.tempdir, "00")
+        d2 = "%s/%s" % (self.tempdir, "01")
+        os.mkdir(d1)
+        os.mkdir(d2)
+        f1 = "%s/%s" % (d1, "service-perfdata.1479712710")
+        f2 = "%s/%s" % (d2, "service-perfdata.1479712720")
+        f3 = "%s/%s" % (d1, "service-perfdata.1479712730")
+        self.touch(f1)
+        self.touch(f2)
+        os.utime(d1, (1479712740, 1479712740))
+        os.utime(d2, (1479712740, 1479712740))
+
+        p._run_job()
+        self.assertEqual(sorted([f1, f2]), sorted(queue.get()))
+        self.assertEqual(2, p._get_waiting())
+
+        # Unmodified directories are not listed again
+        self.touch(f3)
+        os.utime(d1, (1479712740, 1479712740))
+        p._run_job()
+        self.assertEqual(0, queue.qsize())
+
+        # Taken files leave the in-flight index
+        os.rename(f1, f1 + self.conf.file_picked_suffix + "0")
+        p._run_job()
+        self.assertEqual([f3], queue.get())
+        self.assertEqual({d1: set([os.path.basename(f3)]),
+                          d2: set([os.path.basename(f2)])}, p._inflight)
+
+    def test_dispatcher_backpressure(self):
+        registry = metrics.Registry()
+        self.useFixture(fixtures.MockPatchObject(metrics, 'REGISTRY',
+                                                 registry))
+        self.conf.set_override('file_per_worker_pass', 1)
+        manager = multiprocessing.Manager()
+        queue = manager.Queue(1)
+        ack_queue = manager.Queue()
+        p = perfdata_dispatcher.PerfdataDispatcher(0, self.conf, queue,
+                                                   ack_queue)
+
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        f2 = "%s/%s" % (self.tempdir, "service-perfdata.1479712720")
+        f3 = "%s/%s" % (self.tempdir, "service-perfdata.1479712730")
+        self.touch(f1, PERFDATA_SERVICE)
+        self.touch(f2, PERFDATA_SERVICE)
+        self.touch(f3, PERFDATA_SERVICE)
+        for i, path in enumerate((f1, f2, f3)):
+            os.utime(path, (1479712710 + i, 1479712710 + i))
+
+        # Only one chunk fits in the queue, and the backlog is bounded too
+        p._run_job()
+        self.assertEqual(1, queue.qsize())
+        self.assertEqual(1, p._get_waiting())
+        self.assertEqual([f2], [path for path, size in p._backlog])
+        snapshot = registry.snapshot()
+        self.assertEqual(
+            1, snapshot["counters"]["dispatch_saturations_total"])
+        self.assertEqual(1, snapshot["gauges"]["dispatch_backlog_files"])
+
+        # The worker acknowledges the file once processed
+        w = perfdata_processor.PerfdataProcessor(0, self.conf, None,
+                                                 ack_queue=ack_queue)
+        w._client = mock.Mock()
+        w._process_perfdata_files(queue.get())
+        self.assertEqual([f1], ack_queue.get(timeout=5))
+        ack_queue.put([f1])
+
+        p._run_job()
+        self.assertEqual([f2], queue.get())
+        self.assertEqual(set([os.path.basename(f2)]),
+                         p._inflight[self.tempdir])
+
+        # A file gone before being processed is acknowledged too
+        p._run_job()
+        self.assertEqual([f3], queue.get())
+        os.remove(f3)
+        w._process_perfdata_files([f3])
+        p._read_acks(timeout=5)
+        self.assertEqual(1, p._get_waiting())
+        self.assertEqual(0, len(p._backlog))
+
+    def test_dispatcher_terminate(self):
+        registry = metrics.Registry()
+        self.useFixture(fixtures.MockPatchObject(metrics, 'REGISTRY',
+                                                 registry))
+        self.conf.set_override('metrics_listen', "unix:/nonexistent")
+        self.conf.set_override('state_directory', self.useFixture(
+            fixtures.TempDir()).path)
+        self.conf.set_override('interval_delay', 60)
+        self.conf.set_override('file_per_worker_pass', 1)
+        manager = multiprocessing.Manager()
+        queue = manager.Queue(1)
+        p = perfdata_dispatcher.PerfdataDispatcher(0, self.conf, queue,
+                                                   manager.Queue())
+        self.touch("%s/%s" % (self.tempdir, "service-perfdata.1479712710"))
+        self.touch("%s/%s" % (self.tempdir, "service-perfdata.1479712720"))
+
+        # The dispatcher waits for acks with a backlog, it still stops
+        # without waiting for interval_delay
+        thread = threading.Thread(target=p.run)
+        thread.start()
+        timer = timeutils.StopWatch(duration=5).start()
+        while not p._saturated and not timer.expired():
+            time.sleep(0.01)
+        self.assertEqual(1, len(p._backlog))
+        with timeutils.StopWatch() as timer:
+            p.terminate()
+            thread.join()
+        self.assertLess(timer.elapsed(), 5)
+
+        # The metrics dumper is stopped after a last dump
+        self.assertIsNone(registry._dumper)
+        with open(os.path.join(metrics.get_directory(self.conf),
+                               "dispatcher.json")) as f:
+            self.assertEqual(1, jsonutils.loads(f.read())["gauges"][
+                "dispatch_backlog_files"])
+
+    def test_dispatcher_oldest_first(self):
+        self.conf.set_override('bytes_per_worker_pass', 10)
+        queue = multiprocessing.Manager().Queue()
+        p = perfdata_dispatcher.PerfdataDispatcher(0, self.conf, queue)
+
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        f2 = "%s/%s" % (self.tempdir, "service-perfdata.1479712720")
+        f3 = "%s/%s" % (self.tempdir, "service-perfdata.1479712730")
+        self.touch(f1, "x" * 6)
+        self.touch(f2, "x" * 6)
+        self.touch(f3, "x" * 20)
+        os.utime(f1, (1479712750, 1479712750))
+        os.utime(f2, (1479712740, 1479712740))
+        os.utime(f3, (1479712730, 1479712730))
+
+        # Oldest first, in chunks of bytes_per_worker_pass
+        p._run_job()
+        self.assertEqual([f3], queue.get())
+        self.assertEqual([f2, f1], queue.get())
+        self.assertEqual(0, queue.qsize())
 
     def test_processor(self):
         gnocchi_client.update_gnocchi_resource_type(self.conf)
@@ -178,3 +366,744 @@ endpoint = "%s"
         expected_measures = [
             [u'2016-11-21T11:10:00+00:00', 300.0, 9175101.06]]
         self.assertEqual(expected_measures, measures)
+
+    def test_processor_streaming(self):
+        self.conf.set_override('batch_max_measures', 1)
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        self.touch(f1, PERFDATA_SERVICE)
+
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        with mock.patch.object(p, '_post_batch') as post:
+            p._process_perfdata_files([f1])
+
+        # Measures are sent each time the budget is reached
+        self.assertEqual(2, post.call_count)
+        self.assertEqual(["Uptime::uptime"],
+                         list(post.call_args_list[0][0][1]["arn"]))
+        self.assertEqual(5, len(post.call_args_list[1][0][1]["arn"]))
+        self.assertEqual([], os.listdir(self.tempdir))
+
+    def test_processor_split_batch(self):
+        self.conf.set_override('post_max_measures', 3)
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        batch = {
+            "host1": {"load::load1": [{"timestamp": 1, "value": 1}] * 5},
+            "host2": {"load::load1": [{"timestamp": 1, "value": 1}],
+                      "load::load5": [{"timestamp": 1, "value": 1}]},
+        }
+        parts = p._split_batch(batch)
+        self.assertEqual([3, 3, 1],
+                         [sum(len(m) for r in part.values()
+                              for m in r.values())
+                          for part, count in parts])
+        self.assertEqual([3, 3, 1], [count for part, count in parts])
+        merged = {}
+        for part, count in parts:
+            for resource_id, resource_metrics in part.items():
+                for metric, measures in resource_metrics.items():
+                    merged.setdefault(resource_id, {}).setdefault(
+                        metric, []).extend(measures)
+        self.assertEqual(batch, merged)
+
+        self.conf.set_override('post_max_measures', 10000)
+        self.conf.set_override('post_max_bytes', 1024)
+        batch = {"host1": {"load::load1": [{"timestamp": 1, "value": 1}] *
+                           200}}
+        parts = p._encode_batch(batch)
+        self.assertEqual(200, sum(count for data, count, new in parts))
+        for data, count, new in parts:
+            self.assertLessEqual(len(data), 1024)
+            self.assertEqual(count, len(jsonutils.loads(data)["host1"][
+                "load::load1"]))
+
+        # Parts stay within the limit when the measures sizes differ
+        self.conf.set_override('post_max_bytes', 2048)
+        batch = {"host1": {
+            "load::load1": ([{"timestamp": 1, "value": 1}] +
+                            [{"timestamp": 1479726660 + i,
+                              "value": 9175101.06 + i}
+                             for i in range(300)]),
+            "load::load5": [{"timestamp": 1, "value": 1}] * 100,
+        }}
+        parts = p._encode_batch(batch)
+        self.assertEqual(401, sum(count for data, count, new in parts))
+        merged = {}
+        for data, count, new in parts:
+            self.assertLessEqual(len(data), 2048)
+            for metric, measures in jsonutils.loads(data)["host1"].items():
+                merged.setdefault(metric, []).extend(measures)
+        self.assertEqual(batch["host1"], merged)
+
+        # Small batches are encoded once
+        batch = {"host1": {"load::load1": [{"timestamp": 1, "value": 1}]}}
+        self.assertEqual([(utils.dump_as_bytes(batch), 1,
+                           {"host1": ["load::load1"]})],
+                         p._encode_batch(batch))
+
+    def test_processor_convert_value(self):
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        for value in ["0.040", "9175101.06", "-1.658471", "+3", ".5", "1.",
+                      "1e3", "2169.12890625MB", "12KB", "3KiB", "2G", "1.5T",
+                      "1e20K", "5k", "10kB", "8b", "4Kibit", "120ms", "0.5s",
+                      "87%", "3000RPM", "12.1Volts", "45degrees_C", " 7 ",
+                      "12c", "abc"]:
+            try:
+                expected = p._convert_value_slow(value)
+            except perfdata_processor.MalformedPerfdata:
+                self.assertRaises(perfdata_processor.MalformedPerfdata,
+                                  p._convert_value, value)
+            else:
+                self.assertEqual(repr(expected),
+                                 repr(p._convert_value(value)), value)
+
+    def test_processor_timestamp_format(self):
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        self.assertEqual(
+            {'uptime': {'timestamp': '2016-11-21T11:11:00+00:00',
+                        'value': 9175101.06}},
+            p._parse_measures("1479726660", "uptime=9175101.06;;;;"))
+        self.assertRaises(perfdata_processor.MalformedPerfdata,
+                          p._parse_measures, "foo", "uptime=1")
+
+        self.conf.set_override('timestamp_format', 'epoch')
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        self.assertEqual(
+            {'uptime': {'timestamp': 1479726660, 'value': 9175101.06}},
+            p._parse_measures("1479726660", "uptime=9175101.06;;;;"))
+
+    def test_processor_resource_cache(self):
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p._client = mock.Mock()
+        p._client.resource.search.side_effect = [
+            [{'id': str(i), 'original_resource_id': 'host%d' % i}
+             for i in range(perfdata_processor.PREWARM_PAGE_SIZE)],
+            [{'id': 'last', 'original_resource_id': 'arn'}],
+        ]
+        p._prewarm_resources()
+        self.assertEqual(2, p._client.resource.search.call_count)
+        self.assertIn('arn', p._resources)
+        self.assertIn('host0', p._resources)
+
+        # Known resources are posted directly, new ones created first
+        measures = {'timestamp': 1, 'value': 1}
+        p._post_batch(['f'], {'arn': {'load::load1': [measures]},
+                              'new': {'load::load1': [measures]}})
+        p._client.resource.create.assert_called_once_with(
+            "nagios-service", {'id': 'new', 'host': 'new'})
+        self.assertEqual(1, p._client.api.post.call_count)
+        self.assertIn('new', p._resources)
+
+        # Known resources don't expire
+        p._client.api.post.reset_mock()
+        with mock.patch.object(timeutils, 'now',
+                               return_value=timeutils.now() + 86400):
+            p._post_batch(['f'], {'new': {'load::load1': [measures]}})
+        p._client.resource.create.assert_called_once_with(
+            "nagios-service", {'id': 'new', 'host': 'new'})
+        self.assertEqual(1, p._client.api.post.call_count)
+        self.assertEqual({'create_metrics': False},
+                         p._client.api.post.call_args[1]["params"])
+
+    def test_processor_create_resources(self):
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p._client = mock.Mock()
+        resource_ids = ['host%d' % (i % 50) for i in range(200)]
+        p._create_resources(['f'], resource_ids)
+
+        # Each resource is created once, even when requested concurrently
+        self.assertEqual(50, p._client.resource.create.call_count)
+        p._create_resources(['f'], resource_ids)
+        self.assertEqual(50, p._client.resource.create.call_count)
+
+    def test_processor_senders(self):
+        self.conf.set_override('batch_max_measures', 1)
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        self.touch(f1, PERFDATA_SERVICE)
+
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        with mock.patch.object(p, '_post_batch') as post:
+            p._start_senders()
+            p._process_perfdata_files([f1])
+            # Pending batches are sent before exiting
+            p._shutdown_done.set()
+            p.terminate()
+
+        self.assertEqual(2, post.call_count)
+        self.assertEqual(0, p._batches.qsize())
+        for sender in p._senders:
+            self.assertFalse(sender.is_alive())
+
+    def test_processor_claim(self):
+        self.conf.set_override('workers', 2)
+        self.conf.set_override('dispatch_mode', 'claim')
+        for i in range(20):
+            self.touch("%s/service-perfdata.%d" % (self.tempdir, i))
+        self.touch("%s/service-perfdata.0%s1" % (
+            self.tempdir, self.conf.file_picked_suffix))
+
+        p0 = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p1 = perfdata_processor.PerfdataProcessor(1, self.conf, None)
+        paths0 = p0._get_paths()
+        paths1 = p1._get_paths()
+
+        # Each worker gets its own share of the files
+        self.assertTrue(paths0)
+        self.assertTrue(paths1)
+        self.assertEqual(set(), set(paths0) & set(paths1))
+        self.assertEqual(20, len(set(paths0) | set(paths1)))
+
+        # A file taken by another worker is skipped
+        os.remove(paths0[0])
+        with mock.patch.object(p0, '_post_batch'):
+            p0._process_perfdata_files(paths0)
+        self.assertEqual(sorted(paths1 + [
+            "%s/service-perfdata.0%s1" % (
+                self.tempdir, self.conf.file_picked_suffix)]),
+            sorted(os.path.join(self.tempdir, path)
+                   for path in os.listdir(self.tempdir)))
+
+    def test_processor_host_affinity(self):
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        self.touch(f1, "".join(
+            "DATATYPE::SERVICEPERFDATA\tTIMET::1479726660\tHOSTNAME::host%d"
+            "\tSERVICEDESC::Load\tSERVICEPERFDATA::load1=0.5\n" % i
+            for i in range(10)))
+        shard_queues = [six.moves.queue.Queue(), six.moves.queue.Queue()]
+        p0 = perfdata_processor.PerfdataProcessor(0, self.conf, None,
+                                                  shard_queues)
+        p1 = perfdata_processor.PerfdataProcessor(1, self.conf, None,
+                                                  shard_queues)
+        with mock.patch.object(p0, '_post_batch') as post0:
+            p0._process_perfdata_files([f1])
+        with mock.patch.object(p1, '_post_batch') as post1:
+            p1._process_forwarded_lines()
+
+        hosts0 = set(post0.call_args[0][1])
+        hosts1 = set(post1.call_args[0][1])
+        self.assertEqual(set("host%d" % i for i in range(10)),
+                         hosts0 | hosts1)
+        for host in hosts0:
+            self.assertEqual(0, utils.get_shard(host, 2))
+        for host in hosts1:
+            self.assertEqual(1, utils.get_shard(host, 2))
+
+    def test_processor_resubmit_on_crash(self):
+        self.conf.set_override('resubmit_on_crash', True)
+        self.conf.set_override('state_directory', self.useFixture(
+            fixtures.TempDir()).path)
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        f2 = "%s/%s" % (self.tempdir, "service-perfdata.1479712720")
+        self.touch(f1, PERFDATA_SERVICE)
+        self.touch(f2, PERFDATA_SERVICE)
+
+        # The worker crashes while posting the second file
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        with mock.patch.object(p, '_post_batch'):
+            p._process_perfdata_files([f1])
+        p._pending.release = mock.Mock()
+        with mock.patch.object(p, '_post_batch'):
+            p._process_perfdata_files([f2])
+        p._journal.close()
+
+        p2 = f2 + self.conf.file_picked_suffix + "0"
+        self.assertEqual([os.path.basename(p2)], os.listdir(self.tempdir))
+        claimed, acked = journal.Journal.load(p._journal.path)
+        self.assertEqual(set([os.path.basename(p2)]), claimed - acked)
+
+        # Only the file not acknowledged is resubmitted
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        with mock.patch.object(p, '_post_batch') as post:
+            p._recover_picked_files()
+        self.assertEqual(1, post.call_count)
+        self.assertEqual([os.path.basename(p2)], post.call_args[0][0])
+        self.assertEqual([], os.listdir(self.tempdir))
+        claimed, acked = journal.Journal.load(p._journal.path)
+        self.assertEqual(set(), claimed - acked)
+
+    def test_processor_orphan_files(self):
+        self.conf.set_override('workers', 2)
+        self.conf.set_override('resubmit_on_crash', True)
+        self.conf.set_override('state_directory', self.useFixture(
+            fixtures.TempDir()).path)
+        suffix = self.conf.file_picked_suffix
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        f2 = "%s/%s" % (self.tempdir, "service-perfdata.1479712720")
+        f3 = "%s/%s" % (self.tempdir, "service-perfdata.1479712730")
+        self.touch(f1 + suffix + "1", PERFDATA_SERVICE)
+        self.touch(f2 + suffix + "2", PERFDATA_SERVICE)
+        self.touch(f3 + suffix + "3", PERFDATA_SERVICE)
+        j = journal.Journal(os.path.join(self.conf.state_directory,
+                                         "journal-2"))
+        j.claim([os.path.basename(f2) + suffix + "2"])
+        j.ack([os.path.basename(f2) + suffix + "2"])
+        j.close()
+
+        # The workers 2 and 3 are gone, the worker 0 takes their files
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        with mock.patch.object(p, '_post_batch') as post:
+            p._recover_picked_files()
+        self.assertEqual(1, post.call_count)
+        self.assertEqual([os.path.basename(f3) + suffix + "0"],
+                         post.call_args[0][0])
+        self.assertEqual([os.path.basename(f1) + suffix + "1"],
+                         os.listdir(self.tempdir))
+        self.assertEqual(["journal-0"],
+                         os.listdir(self.conf.state_directory))
+
+    def test_processor_post_failure(self):
+        self.conf.set_override('resubmit_on_crash', True)
+        self.conf.set_override('state_directory', self.useFixture(
+            fixtures.TempDir()).path)
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        self.touch(f1, PERFDATA_SERVICE)
+        p1 = f1 + self.conf.file_picked_suffix + "0"
+        ack_queue = six.moves.queue.Queue()
+
+        # The post fails, the file is kept claimed and not acknowledged
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None,
+                                                 ack_queue=ack_queue)
+        p._client = mock.Mock()
+        p._client.api.post.side_effect = Exception("Gnocchi error")
+        self.assertRaises(Exception, p._process_perfdata_files, [f1])
+        p._journal.close()
+        self.assertEqual([os.path.basename(p1)], os.listdir(self.tempdir))
+        claimed, acked = journal.Journal.load(p._journal.path)
+        self.assertEqual(set([os.path.basename(p1)]), claimed - acked)
+        self.assertTrue(ack_queue.empty())
+
+        # The same with the senders threads
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None,
+                                                 ack_queue=ack_queue)
+        p._client = mock.Mock()
+        p._client.api.post.side_effect = Exception("Gnocchi error")
+        p._start_senders()
+        p._recover_picked_files()
+        p._shutdown_done.set()
+        p.terminate()
+        p._journal.close()
+        self.assertEqual([os.path.basename(p1)], os.listdir(self.tempdir))
+        self.assertTrue(ack_queue.empty())
+
+        # It's resubmitted when the worker restarts
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None,
+                                                 ack_queue=ack_queue)
+        p._client = mock.Mock()
+        p._recover_picked_files()
+        self.assertEqual([], os.listdir(self.tempdir))
+        self.assertEqual([f1], ack_queue.get_nowait())
+
+    def test_processor_spill(self):
+        self.conf.set_override('spill_on_failure', True)
+        self.conf.set_override('state_directory', self.useFixture(
+            fixtures.TempDir()).path)
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        self.touch(f1, PERFDATA_SERVICE)
+
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p._client = mock.Mock()
+        post = p._client.api.post
+        post.side_effect = ka_exc.ConnectFailure()
+
+        # Measures are spilled and the file is done
+        p._process_perfdata_files([f1])
+        self.assertTrue(p._gnocchi_down.is_set())
+        self.assertEqual([], os.listdir(self.tempdir))
+        self.assertEqual(1, post.call_count)
+
+        # They are replayed once Gnocchi is back
+        post.side_effect = None
+        p._replay_spill()
+        self.assertFalse(p._gnocchi_down.is_set())
+        self.assertEqual(2, post.call_count)
+        self.assertEqual(6, len(jsonutils.loads(
+            post.call_args[1]["data"])["arn"]))
+        self.assertEqual([], p._spill.segments())
+        self.assertFalse(p._spill.active)
+
+    def test_processor_orphan_spills(self):
+        self.conf.set_override('workers', 2)
+        self.conf.set_override('spill_on_failure', True)
+        self.conf.set_override('state_directory', self.useFixture(
+            fixtures.TempDir()).path)
+        for worker_id, data in ((1, b'{"one": {}}'), (2, b'{"two": {}}'),
+                                (3, b'{"three": {}}')):
+            buf = spill.SpillBuffer(os.path.join(
+                self.conf.state_directory, "spill-%d" % worker_id), 1)
+            buf.write(data, 1)
+            buf.close()
+
+        # The workers 2 and 3 are gone, the worker 0 replays their measures
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p._client = mock.Mock()
+        p._adopt_orphan_spills()
+        self.assertEqual(["spill-0", "spill-1"],
+                         sorted(os.listdir(self.conf.state_directory)))
+        self.assertTrue(p._spill.active)
+        p._replay_spill()
+        self.assertEqual(
+            [b'{"three": {}}', b'{"two": {}}'],
+            sorted(call[1]["data"]
+                   for call in p._client.api.post.call_args_list))
+        self.assertEqual([], p._spill.segments())
+
+    def test_metrics(self):
+        registry = metrics.Registry()
+        self.useFixture(fixtures.MockPatchObject(metrics, 'REGISTRY',
+                                                 registry))
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        self.touch(f1, PERFDATA_SERVICE + "garbage\n")
+
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p._client = mock.Mock()
+        p._process_perfdata_files([f1])
+        snapshot = registry.snapshot()
+        self.assertEqual(1, snapshot["counters"]["files_claimed_total"])
+        self.assertEqual(2, snapshot["counters"]["lines_parsed_total"])
+        self.assertEqual(1, snapshot["counters"]["lines_malformed_total"])
+        self.assertEqual(6, snapshot["counters"]["measures_posted_total"])
+        self.assertEqual(1, snapshot["counters"]["resources_created_total"])
+        self.assertEqual(
+            1, snapshot["counters"]["resource_cache_misses_total"])
+        self.assertEqual(1, snapshot["histograms"]["batch_bytes"]["count"])
+
+        # Workers are reported alone and aggregated
+        directory = self.useFixture(fixtures.TempDir()).path
+        registry.dump(os.path.join(directory, "processor-0.json"))
+        registry.dump(os.path.join(directory, "processor-1.json"))
+        listen = os.path.join(directory, "metrics.sock")
+        server = metrics.get_server("unix:%s" % listen, directory)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+
+        s = socket.socket(socket.AF_UNIX)
+        s.connect(listen)
+        s.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            response += data
+        s.close()
+        body = response.decode("utf-8")
+        self.assertIn("200 OK", body)
+        self.assertIn('gnocchi_nagios_lines_parsed_total'
+                      '{worker="processor-0"} 2.0\n', body)
+        self.assertIn('gnocchi_nagios_lines_parsed_total 4.0\n', body)
+        self.assertIn('gnocchi_nagios_batch_bytes_bucket{le="+Inf"} 2\n',
+                      body)
+        self.assertIn('gnocchi_nagios_post_latency_seconds_count'
+                      '{worker="processor-1"} 1\n', body)
+        self.assertIn('gnocchi_nagios_processing_skew_ratio 0.0\n', body)
+        self.assertEqual(1.0, metrics.get_processing_skew({
+            "dispatcher": {"counters": {"processing_seconds_total": 0}},
+            "processor-0": {"counters": {"processing_seconds_total": 1}},
+            "processor-1": {"counters": {"processing_seconds_total": 3}}}))
+        self.assertEqual(1, snapshot["histograms"]["pass_duration_seconds"]
+                         ["count"])
+
+        # Only a socket left by a previous run is replaced
+        path = os.path.join(directory, "not-a-socket")
+        self.touch(path, "")
+        self.assertRaises(ValueError, metrics.get_server, "unix:%s" % path,
+                          directory)
+        self.assertTrue(os.path.exists(path))
+
+    def test_processor_fake_gnocchi(self):
+        fake = bench.FakeGnocchi().start()
+        self.addCleanup(fake.stop)
+        lines, measures = bench.generate_spool(
+            self.tempdir, files=3, hosts=4, services=3, metrics=5,
+            lines_per_file=7)
+        self.assertEqual(21, lines)
+
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p._client = gnocchi_client.get_gnocchiclient(
+            self.conf, endpoint_override=fake.url)
+        paths = [os.path.join(self.tempdir, name)
+                 for name in sorted(os.listdir(self.tempdir))]
+        p._process_perfdata_files(paths[:1])
+        self.assertEqual(2, len(fake.resources))
+
+        # Resources removed from Gnocchi are created again
+        fake.resources.clear()
+        p._process_perfdata_files(paths[1:])
+        self.assertEqual(measures, fake.measures)
+        self.assertEqual(4, len(fake.resources))
+        self.assertEqual([], os.listdir(self.tempdir))
+
+    def test_receiver(self):
+        fake = bench.FakeGnocchi().start()
+        self.addCleanup(fake.stop)
+        data = "".join(bench.generate_perfdata(
+            hosts=2, services=2, metrics=3, timet=1479726660)).encode()
+
+        listen = os.path.join(self.tempdir, "perfdata.sock")
+        self.conf.set_override('perfdata_listen', "unix:%s" % listen)
+        r = perfdata_receiver.PerfdataReceiver(0, self.conf)
+        self.addCleanup(r._listener.close)
+        r._client = gnocchi_client.get_gnocchiclient(
+            self.conf, endpoint_override=fake.url)
+
+        # The last line is sent in two parts
+        s = socket.socket(socket.AF_UNIX)
+        s.connect(listen)
+        s.sendall(data[:-10])
+        r._receive(timeout=5)
+        r._receive(timeout=5)
+        self.assertEqual(17, r._batch.size)
+        s.sendall(data[-10:])
+        s.close()
+        r._receive(timeout=5)
+        r._receive(timeout=5)
+        self.assertEqual(0, len(r._buffers))
+
+        # Lines are posted together once the linger delay is elapsed
+        r._flush_batch(force=False)
+        self.assertEqual(0, fake.measures)
+        r._batch.created_at -= perfdata_receiver.MIN_LINGER
+        r._flush_batch(force=False)
+        self.assertEqual(20, fake.measures)
+        self.assertEqual(1, fake.requests)
+
+        # The whole line too long is ignored
+        self.useFixture(fixtures.MockPatchObject(perfdata_receiver,
+                                                 'MAX_LINE_SIZE', 100))
+        registry = metrics.Registry()
+        self.useFixture(fixtures.MockPatchObject(metrics, 'REGISTRY',
+                                                 registry))
+        s = socket.socket(socket.AF_UNIX)
+        s.connect(listen)
+        r._receive(timeout=5)
+        s.sendall(b"x" * 150)
+        r._receive(timeout=5)
+        s.sendall(b"y" * 150)
+        r._receive(timeout=5)
+        s.sendall(b"z" * 50 + b"\n" + data[:data.index(b"\n") + 1])
+        r._receive(timeout=5)
+        s.close()
+        r._receive(timeout=5)
+        self.assertEqual(4, r._batch.size)
+        self.assertEqual(0, len(r._discarding))
+        self.assertEqual(
+            1, registry.snapshot()["counters"]["lines_malformed_total"])
+        r._flush_batch()
+        self.assertEqual(24, fake.measures)
+
+        # Lines can be written into a named pipe too
+        pipe = os.path.join(self.tempdir, "perfdata.pipe")
+        self.conf.set_override('perfdata_listen', "fifo:%s" % pipe)
+        r = perfdata_receiver.PerfdataReceiver(0, self.conf)
+        self.addCleanup(r._listener.close)
+        r._client = gnocchi_client.get_gnocchiclient(
+            self.conf, endpoint_override=fake.url)
+        fd = os.open(pipe, os.O_WRONLY)
+        os.write(fd, data)
+        os.close(fd)
+        r._receive(timeout=5)
+        r._flush_batch()
+        self.assertEqual(44, fake.measures)
+
+        # Only sockets are replaced
+        self.conf.set_override('perfdata_listen', "unix:%s" % pipe)
+        self.assertRaises(ValueError, perfdata_receiver.PerfdataReceiver,
+                          0, self.conf)
+
+    def test_replay(self):
+        fake = bench.FakeGnocchi().start()
+        self.addCleanup(fake.stop)
+        archives = self.useFixture(fixtures.TempDir()).path
+        lines, measures = bench.generate_spool(
+            self.tempdir, files=4, hosts=4, services=3, metrics=5,
+            lines_per_file=7)
+        f1, f2, f3, f4 = [os.path.join(self.tempdir, name)
+                          for name in sorted(os.listdir(self.tempdir))]
+        with open(f1, 'rb') as src:
+            with gzip.open(os.path.join(archives, "a.gz"), 'wb') as dst:
+                dst.write(src.read())
+        tar = os.path.join(archives, "b.tar.gz")
+        with tarfile.open(tar, 'w:gz') as dst:
+            dst.add(f2, "f2")
+            dst.add(f3, "f3")
+        os.rename(f4, os.path.join(archives, "c"))
+
+        with open(f3) as f:
+            f3_measures = sum(4 if line.startswith("DATATYPE::HOSTPERFDATA")
+                              else 5 for line in f)
+
+        conffile = self.create_tempfiles([('replay.conf', """
+[DEFAULT]
+state_directory = %s
+
+[gnocchi]
+auth_type = gnocchi-basic
+user = admin
+endpoint = %s
+""" % (self.useFixture(fixtures.TempDir()).path, fake.url))])[0]
+        conf = cli.prepare_service([archives, "--processes", "2"],
+                                   [conffile], cli_opts=replay.CLI_OPTS)
+        self.assertEqual(0, replay.replay(conf))
+        self.assertEqual(measures, fake.measures)
+        checkpoint = os.path.join(conf.state_directory, replay.CHECKPOINT)
+        self.assertEqual(
+            set([os.path.join(archives, "a.gz"), tar, tar + ":f2",
+                 tar + ":f3", os.path.join(archives, "c")]),
+            journal.Journal.load(checkpoint)[1])
+
+        # Imported files are skipped
+        self.assertEqual(0, replay.replay(conf))
+        self.assertEqual(measures, fake.measures)
+
+        # Interrupted archives are resumed
+        with open(checkpoint, 'w') as f:
+            f.write("A %s\nA %s:f2\nA %s\n" % (
+                os.path.join(archives, "a.gz"), tar,
+                os.path.join(archives, "c")))
+        self.assertEqual(0, replay.replay(conf))
+        self.assertEqual(measures + f3_measures, fake.measures)
+
+    def test_processor_compression(self):
+        fake = bench.FakeGnocchi().start()
+        self.addCleanup(fake.stop)
+        fake.resources.add("arn")
+        batch = {"arn": {"load::load1": [{"timestamp": 1, "value": 1}] * 50}}
+        for encoding in ("gzip", "deflate"):
+            self.conf.set_override('post_compression', encoding)
+            p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+            p._client = gnocchi_client.get_gnocchiclient(
+                self.conf, endpoint_override=fake.url)
+            parts = p._encode_batch(batch)
+            self.assertEqual(encoding,
+                             utils.get_content_encoding(parts[0][0]))
+            self.assertLess(len(parts[0][0]),
+                            len(utils.dump_as_bytes(batch)) / 4)
+            p._post_batch(["f"], batch)
+        self.assertEqual(100, fake.measures)
+
+    def test_processor_batch_names(self):
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        batch = perfdata_processor.Batch()
+        measure = {"timestamp": 1, "value": 1}
+        for i in range(2):
+            p._add_to_batch(batch, "arn/1", "fs_/", {"/var": measure,
+                                                     "growth": measure})
+        self.assertEqual({"arn@1": {"fs_@::@var": [measure, measure],
+                                    "fs_@::growth": [measure, measure]}},
+                         batch.measures)
+        self.assertEqual(4, batch.size)
+        self.assertEqual(3, p._names_count)
+
+        # The names are rebuilt when the table is full
+        with mock.patch.object(perfdata_processor, 'NAMES_CACHE_SIZE', 3):
+            p._add_to_batch(batch, "other", "load", {"load1": measure})
+        self.assertEqual(2, p._names_count)
+        self.assertEqual({"other": "other"}, p._resource_ids)
+
+    def test_processor_known_metrics(self):
+        fake = bench.FakeGnocchi().start()
+        self.addCleanup(fake.stop)
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p._client = gnocchi_client.get_gnocchiclient(
+            self.conf, endpoint_override=fake.url)
+        measure = {"timestamp": 1, "value": 1}
+
+        p._post_batch(["f"], {"arn": {"load::load1": [measure]}})
+        self.assertEqual(1, fake.create_metrics_requests)
+        self.assertEqual(frozenset(["load::load1"]),
+                         p._resources.get_metrics("arn"))
+
+        # Known metrics are sent without create_metrics
+        p._post_batch(["f"], {"arn": {"load::load1": [measure]}})
+        self.assertEqual(2, fake.requests)
+        self.assertEqual(1, fake.create_metrics_requests)
+
+        # New and deleted metrics are created
+        p._post_batch(["f"], {"arn": {"load::load1": [measure],
+                                      "load::load5": [measure]}})
+        fake.metrics["arn"].clear()
+        p._post_batch(["f"], {"arn": {"load::load1": [measure]}})
+        self.assertEqual(4, fake.requests)
+        self.assertEqual(3, fake.create_metrics_requests)
+        self.assertEqual(5, fake.measures)
+
+    def test_processor_coalesce(self):
+        self.conf.set_override('coalesce_measures', True)
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+
+        def m(timestamp, value):
+            return {"timestamp": timestamp, "value": value}
+
+        batch = {"arn": {"load::load1": [m(1, 1), m(1, 1), m(1, 2), m(2, 1)],
+                         "load::load5": [m(1, 1)]}}
+        p._coalesce_batch(batch)
+        self.assertEqual({"arn": {"load::load1": [m(1, 1), m(1, 2), m(2, 1)],
+                                  "load::load5": [m(1, 1)]}}, batch)
+
+        # Measures sent recently are removed too
+        self.conf.set_override('coalesce_window', 60)
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        p._client = mock.Mock()
+        p._post_batch(["f"], {"arn": {"load::load1": [m(1, 1)]}})
+        p._post_batch(["f"], {"arn": {"load::load1": [m(1, 1)]}})
+        p._post_batch(["f"], {"arn": {"load::load1": [m(1, 2), m(1, 1)]}})
+        self.assertEqual(2, p._client.api.post.call_count)
+        self.assertEqual({"arn": {"load::load1": [m(1, 2)]}}, jsonutils.loads(
+            p._client.api.post.call_args[1]["data"]))
+
+        # Measures of a failed post are not known as sent
+        p._client.api.post.side_effect = RuntimeError("boom")
+        self.assertRaises(RuntimeError, p._post_batch, ["f"],
+                          {"arn": {"load::load1": [m(2, 1)]}})
+        p._client.api.post.side_effect = None
+        p._post_batch(["f"], {"arn": {"load::load1": [m(2, 1)]}})
+        self.assertEqual(4, p._client.api.post.call_count)
+        self.assertEqual({"arn": {"load::load1": [m(2, 1)]}}, jsonutils.loads(
+            p._client.api.post.call_args[1]["data"]))
+
+        # Measures are aggregated by granularity
+        self.conf.set_override('coalesce_window', 0)
+        self.conf.set_override('aggregation_granularity', 300)
+        self.conf.set_override('timestamp_format', 'epoch')
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        batch = perfdata_processor.Batch()
+        for timet, value in (("1479726660", "1"), ("1479726720", "2"),
+                             ("1479726960", "6")):
+            p._add_to_batch(batch, "arn", "load", p._parse_measures(
+                timet, "load1=%s;;;;" % value))
+        p._coalesce_batch(batch.measures)
+        self.assertEqual({"arn": {"load::load1": [m(1479726600, 1.5),
+                                                  m(1479726900, 6.0)]}},
+                         batch.measures)
+
+    def test_processor_linger(self):
+        self.conf.set_override('batch_linger', 30)
+        f1 = "%s/%s" % (self.tempdir, "service-perfdata.1479712710")
+        f2 = "%s/%s" % (self.tempdir, "service-perfdata.1479712720")
+        self.touch(f1, PERFDATA_SERVICE)
+        self.touch(f2, PERFDATA_SERVICE)
+
+        p = perfdata_processor.PerfdataProcessor(0, self.conf, None)
+        with mock.patch.object(p, '_post_batch') as post:
+            # Measures of several passes are sent together
+            p._process_perfdata_files([f1])
+            p._process_perfdata_files([f2])
+            p._flush_batch(force=False)
+            self.assertEqual(0, post.call_count)
+            self.assertEqual(2, len(os.listdir(self.tempdir)))
+            self.assertLessEqual(p._get_timeout(10), 30)
+
+            p._batch.created_at -= 30
+            self.assertEqual(0, p._get_timeout(10))
+            p._flush_batch(force=False)
+            self.assertEqual(1, post.call_count)
+            self.assertEqual(12, sum(len(measures) for measures in
+                                     post.call_args[0][1]["arn"].values()))
+            self.assertEqual([], os.listdir(self.tempdir))
+
+            # Or when the estimated size is reached
+            self.conf.set_override('batch_max_bytes', 1024)
+            self.touch(f1, PERFDATA_SERVICE * 10)
+            p._process_perfdata_files([f1])
+            self.assertEqual(4, post.call_count)
@@ -0,0 +1,173 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import errno
+import os
+import stat
+import threading
+import zlib
+
+from oslo_serialization import jsonutils
+from oslo_utils import importutils
+from oslo_utils import timeutils
+import six
+
+orjson = importutils.try_import('orjson')
+ujson = importutils.try_import('ujson')
+# NOTE: os.scandir() is only available on Python >= 3.5
+_scandir = getattr(os, 'scandir', None)
+if _scandir is None:
+    _scandir = getattr(importutils.try_import('scandir'), 'scandir', None)
+
+
+def _ujson_dump_as_bytes(obj):
+    return ujson.dumps(obj).encode('utf-8')
+
+
+# NOTE: Use a faster JSON encoder when installed. ujson < 2.0
+# rounds floats, so it's not used.
+if orjson is not None:
+    dump_as_bytes = orjson.dumps
+elif ujson is not None and int(ujson.__version__.split('.')[0]) >= 2:
+    dump_as_bytes = _ujson_dump_as_bytes
+else:
+    dump_as_bytes = jsonutils.dump_as_bytes
+
+
+class LRUCache(object):
+    """Size bounded dict that evicts the least recently used keys
+
+    When ttl is set, keys also expire ttl seconds after they have been set.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expire_at = self._data.pop(key)
+            except KeyError:
+                return default
+            if expire_at is not None and expire_at < timeutils.now():
+                return default
+            self._data[key] = value, expire_at
+            return value
+
+    def set(self, key, value):
+        expire_at = None if self._ttl is None else timeutils.now() + self._ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, expire_at
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def compress(data, encoding, level):
+    """Compress data for the gzip or deflate Content-Encoding"""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return zlib.compress(data, level)
+
+
+def get_content_encoding(data):
+    """Return the Content-Encoding of JSON data returned by compress()"""
+    # NOTE: JSON never starts with these bytes, this allows to
+    # replay the spilled data even if the compression option has changed
+    if data[:2] == b"\x1f\x8b":
+        return 'gzip'
+    elif data[:1] == b"\x78":
+        return 'deflate'
+    return None
+
+
+class _DirEntry(object):
+    """Minimal os.DirEntry when scandir is not available"""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def stat(self):
+        return os.stat(self.path)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+
+def scandir(path):
+    """Return an iterator of os.DirEntry like objects of a directory
+
+    The entries are only stat()ed on demand, so known files can be skipped
+    for free.
+    """
+    if _scandir is not None:
+        return _scandir(path)
+    return (_DirEntry(path, name) for name in os.listdir(path))
+
+
+def list_spool_directories(conf):
+    """Return the directories where the perfdata files are written"""
+    if not conf.spool_subdirectories:
+        return [conf.spool_directory]
+    return sorted(entry.path for entry in scandir(conf.spool_directory)
+                  if entry.is_dir())
+
+
+def get_shard(key, shards):
+    """Return the shard of a key, stable across processes and restarts"""
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+def ensure_directory(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def remove_stale_socket(path):
+    """Remove the UNIX socket left by a previous run before binding path
+
+    Anything else than a socket is left untouched.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError("%s is not a socket" % path)
+    os.remove(path)
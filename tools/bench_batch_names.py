@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cost of building the resource ids and metric names
+
+Usage: python tools/bench_batch_names.py [--measures 1000000]
+           [--hosts 1000] [--services 10]
+
+It adds --measures measures to a batch with PerfdataProcessor._add_to_batch()
+and with the previous implementation that built the names for each measure,
+then prints the time spent and the memory allocated for the batch (Python 3
+only) per million measures.
+"""
+
+import argparse
+import time
+
+from gnocchi_nagios import cli
+from gnocchi_nagios import perfdata_processor
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def legacy_add_to_batch(self, batch, host, service, measures):
+    resource_id = host.replace('/', self._conf.slash_replacement)
+    r = batch.measures.setdefault(resource_id, {})
+    for metric, value in measures.items():
+        metric = "%s%s%s" % (service, self._conf.metric_delim, metric)
+        metric = metric.replace('/', self._conf.slash_replacement)
+        r.setdefault(metric, []).append(value)
+    batch.size += len(measures)
+
+
+def get_lines(args):
+    measure = {'timestamp': '2016-11-21T11:10:00+00:00', 'value': 1.0}
+    lines = []
+    for h in range(args.hosts):
+        for s in range(args.services):
+            # NOTE: like what _process_perfdata_line returns
+            lines.append(("host-%d.example.com" % h,
+                          "fs_/var/lib/%d" % s,
+                          dict(("/dev/sd%d" % m, measure) for m in range(4))))
+    return lines
+
+
+def fill_batch(p, add_to_batch, lines, count):
+    batch = perfdata_processor.Batch()
+    while batch.size < count:
+        for host, service, measures in lines:
+            add_to_batch(p, batch, host, service, measures)
+    return batch
+
+
+def run(p, add_to_batch, lines, count):
+    start = time.time()
+    size = fill_batch(p, add_to_batch, lines, count).size
+    elapsed = time.time() - start
+
+    # NOTE: tracemalloc slows down everything, so it's a second run
+    allocated = 0
+    if tracemalloc is not None:
+        tracemalloc.start()
+        # NOTE: the batch is still referenced when measuring
+        batch = fill_batch(p, add_to_batch, lines, count)  # noqa
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return elapsed, allocated, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--measures', type=int, default=1000000)
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--services', type=int, default=10)
+    args = parser.parse_args()
+
+    p = perfdata_processor.PerfdataProcessor.__new__(
+        perfdata_processor.PerfdataProcessor)
+    p._conf = cli.prepare_service([], [])
+    p._resource_ids = {}
+    p._metric_names = {}
+    p._names_count = 0
+    lines = get_lines(args)
+
+    for name, add_to_batch in (
+            ("legacy", legacy_add_to_batch),
+            ("memoized", perfdata_processor.PerfdataProcessor._add_to_batch)):
+        elapsed, allocated, size = run(p, add_to_batch, lines,
+                                       args.measures)
+        print("%-9s %.3fs and %.1fMB allocated per million measures" % (
+            name, elapsed * 1e6 / size, allocated * 1e6 / size / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmark of the perfdata value/unit conversion
+
+Usage: python tools/bench_convert_value.py [--number 100000]
+
+It prints the per value cost of PerfdataProcessor._convert_value() and of
+the exception driven PerfdataProcessor._convert_value_slow(), and fails if
+they don't return the exact same results.
+"""
+
+import argparse
+import struct
+import timeit
+
+from gnocchi_nagios import perfdata_processor
+
+VALUES = ["0.040", "8.775", "9175101.06", "61167", "-1.658471", "0",
+          "2169.12890625MB", "4909.625MB", "12KB", "3KiB", "2G", "1.5T",
+          "10kB", "8b", "120ms", "0.5s", "87%", "3000RPM", "12.1Volts",
+          "45degrees_C"]
+
+
+def result(func, value):
+    try:
+        return struct.pack("d", func(value))
+    except Exception as e:
+        return type(e)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    p = perfdata_processor.PerfdataProcessor.__new__(
+        perfdata_processor.PerfdataProcessor)
+
+    for value in VALUES:
+        if result(p._convert_value, value) != result(p._convert_value_slow,
+                                                     value):
+            raise SystemExit("%s: results differ" % value)
+
+    print("%-18s %12s %12s %8s" % ("value", "slow (ns)", "fast (ns)",
+                                   "speedup"))
+    total_slow = total_fast = 0
+    for value in VALUES:
+        slow = min(timeit.repeat(lambda: p._convert_value_slow(value),
+                                 number=args.number, repeat=3))
+        fast = min(timeit.repeat(lambda: p._convert_value(value),
+                                 number=args.number, repeat=3))
+        total_slow += slow
+        total_fast += fast
+        print("%-18s %12.0f %12.0f %7.1fx" % (
+            value, slow * 1e9 / args.number, fast * 1e9 / args.number,
+            slow / fast))
+    print("%-18s %12.0f %12.0f %7.1fx" % (
+        "mean", total_slow * 1e9 / args.number / len(VALUES),
+        total_fast * 1e9 / args.number / len(VALUES),
+        total_slow / total_fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the journal overhead per batch
+
+Usage: python tools/bench_journal.py [--batches 2000] [--files 100]
+
+Each batch claims then acknowledges --files files, like a worker pass does
+with resubmit_on_crash enabled.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from gnocchi_nagios import journal
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batches', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=100)
+    args = parser.parse_args()
+
+    names = ["service-perfdata.%d-processed-by-worker-0" % i
+             for i in range(args.files)]
+    tmp = tempfile.mkdtemp()
+    try:
+        for fsync_interval in (0, 0.1, 1.0):
+            j = journal.Journal(os.path.join(tmp, "journal-%s" %
+                                             fsync_interval), fsync_interval)
+            start = time.time()
+            for i in range(args.batches):
+                j.claim(names)
+                j.ack(names)
+            elapsed = time.time() - start
+            j.close()
+            print("fsync_interval=%-4s %d files/batch: %.1fus per batch" % (
+                fsync_interval, args.files,
+                elapsed * 1e6 / args.batches))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
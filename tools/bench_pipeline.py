@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the end-to-end throughput of gnocchi-nagios
+
+Usage: python tools/bench_pipeline.py [--workers 1,2,4] [--files 50]
+           [--lines-per-file 10000] [--hosts 1000] [--services 10]
+           [--metrics 4] [--delay 0.01] [--dispatch-mode queue]
+
+For each number of workers, a spool directory is filled with synthetic
+perfdata, then the gnocchi-nagios service is started against a fake Gnocchi
+server, until all measures are received. The extra options are written as
+is in the [DEFAULT] section of the configuration, ie: --option
+batch_max_measures=10000.
+
+It reports the lines per second, the delay before the first measures are
+received and the peak RSS of all the service processes (Linux only).
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from gnocchi_nagios.tests import bench
+
+CONFIG = """
+[DEFAULT]
+spool_directory = %(spool)s
+state_directory = %(state)s
+workers = %(workers)d
+dispatch_mode = %(dispatch_mode)s
+interval_delay = 1
+%(options)s
+
+[gnocchi]
+auth_type = gnocchi-basic
+user = admin
+endpoint = %(endpoint)s
+"""
+
+
+def get_rss(pid):
+    """Return the RSS in bytes of a process and all its children"""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        parents.setdefault(ppid, []).append(int(entry))
+
+    rss = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        pids.extend(parents.get(current, []))
+        try:
+            with open("/proc/%d/status" % current) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except IOError:
+            continue
+    return rss
+
+
+def run(args, workers, tmp):
+    spool = os.path.join(tmp, "spool-%d" % workers)
+    state = os.path.join(tmp, "state-%d" % workers)
+    os.mkdir(spool)
+    os.mkdir(state)
+    lines, measures = bench.generate_spool(
+        spool, args.files, args.hosts, args.services, args.metrics,
+        args.lines_per_file)
+
+    fake = bench.FakeGnocchi(delay=args.delay).start()
+    config = os.path.join(tmp, "gnocchi-nagios-%d.conf" % workers)
+    with open(config, 'w') as f:
+        f.write(CONFIG % {"spool": spool, "state": state,
+                          "workers": workers,
+                          "dispatch_mode": args.dispatch_mode,
+                          "options": "\n".join(args.option),
+                          "endpoint": fake.url})
+
+    start = time.time()
+    service = subprocess.Popen(
+        [sys.executable, "-c",
+         "from gnocchi_nagios import cli; cli.main()",
+         "--config-file=%s" % config],
+        preexec_fn=os.setsid,
+        stdout=open(os.path.join(tmp, "service-%d.log" % workers), 'w'),
+        stderr=subprocess.STDOUT)
+    rss = 0
+    try:
+        while fake.measures < measures:
+            if service.poll() is not None:
+                raise RuntimeError("gnocchi-nagios exited, see %s" % tmp)
+            if time.time() - start > args.timeout:
+                raise RuntimeError("%d/%d measures received after %ds" % (
+                    fake.measures, measures, args.timeout))
+            if sys.platform.startswith("linux"):
+                rss = max(rss, get_rss(service.pid))
+            time.sleep(0.1)
+    finally:
+        os.killpg(service.pid, signal.SIGTERM)
+        service.wait()
+        fake.stop()
+
+    elapsed = fake.last_measures_at - start
+    print("workers=%-3d %d lines %d measures: %.0f lines/s, first measures "
+          "after %.3fs, %d requests, peak RSS %.1fMB" % (
+              workers, lines, measures, lines / elapsed,
+              fake.first_measures_at - start, fake.requests,
+              rss / 1024.0 / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default="1,2,4")
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--lines-per-file', type=int, default=10000)
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--services', type=int, default=10)
+    parser.add_argument('--metrics', type=int, default=4)
+    parser.add_argument('--delay', type=float, default=0.01,
+                        help='seconds added to each fake Gnocchi POST')
+    parser.add_argument('--dispatch-mode', default='queue',
+                        choices=('queue', 'claim'))
+    parser.add_argument('--option', action='append', default=[],
+                        help='extra name=value configuration option')
+    parser.add_argument('--timeout', type=int, default=600)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for workers in [int(w) for w in args.workers.split(",")]:
+            run(args, workers, tmp)
+    except RuntimeError as e:
+        print(str(e))
+        sys.exit(1)
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the spool polling and inotify dispatching paths
+
+Usage: python tools/bench_spool_watch.py [--files 100000]
+
+It fills a temporary spool directory with --files files, then measures the
+cost of one polling pass and the latency between a file being moved into
+the spool and its dispatch to the workers queue.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from six.moves import queue as six_queue
+
+from gnocchi_nagios import cli
+from gnocchi_nagios import perfdata_dispatcher
+
+
+def make_dispatcher(spool, watcher):
+    conf = cli.prepare_service([], [])
+    conf.set_override('spool_directory', spool)
+    conf.set_override('spool_watcher', watcher)
+    return perfdata_dispatcher.PerfdataDispatcher(0, conf, six_queue.Queue())
+
+
+def touch(path):
+    with open(path, 'w') as f:
+        f.write("x")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--samples', type=int, default=20)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    spool = os.path.join(tmp, "ready")
+    incoming = os.path.join(tmp, "nagios")
+    os.mkdir(spool)
+    os.mkdir(incoming)
+    try:
+        for i in range(args.files):
+            touch(os.path.join(spool, "service-perfdata.%d" % i))
+
+        for watcher in ('polling', 'inotify'):
+            d = make_dispatcher(spool, watcher)
+            start = time.time()
+            d._run_job()
+            first = time.time() - start
+            start = time.time()
+            d._run_job()
+            steady = time.time() - start
+
+            latencies = []
+            for i in range(args.samples):
+                src = os.path.join(incoming, "new.%d" % i)
+                touch(src)
+                start = time.time()
+                os.rename(src, os.path.join(spool, "new.%s.%d" %
+                                            (watcher, i)))
+                if watcher == 'inotify':
+                    while d._queue.empty():
+                        d._run_events(d._watcher.read(timeout=1)[0])
+                    latencies.append(time.time() - start)
+                else:
+                    # NOTE: polling dispatches on the next pass, that
+                    # is interval_delay/2 on average plus the scan itself.
+                    d._run_job()
+                    latencies.append(time.time() - start +
+                                     d._conf.interval_delay / 2.0)
+                while not d._queue.empty():
+                    d._queue.get()
+
+            print("%-8s %d files: first pass %.3fs, steady pass %.3fs, "
+                  "mean dispatch latency %.3fms" % (
+                      watcher, args.files, first, steady,
+                      sum(latencies) * 1000 / len(latencies)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()